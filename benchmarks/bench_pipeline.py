@@ -0,0 +1,300 @@
+"""Benchmark por etapas del pipeline de Compras Públicas.
+
+Para cada tamaño de dataset arranca un proceso nuevo (así el pico de memoria
+es el de ese tamaño), levanta la API simulada de `servidor_mock.py` y mide:
+
+- páginas/s de /search_ocds y ocids/s de /record contra el mock,
+- filas/s de normalización, escritura del almacén, carga con esquema y rollups,
+- tiempo de construcción de las figuras Plotly del dashboard,
+- pico de memoria (RSS) del proceso.
+
+Las etapas de red se limitan con --max-registros-red y --max-ocids (un millón
+de peticiones a /record no es un benchmark razonable); las etapas locales
+usan siempre el tamaño completo. El resultado se escribe en JSON.
+
+    python benchmarks/bench_pipeline.py --tallas 1000 10000 100000 1000000 --latencia-ms 20 --tasa-error 0.01
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+DIRECTORIO = Path(__file__).resolve().parent
+RAIZ = DIRECTORIO.parent
+ANIO = 2024
+PROVINCIA = "Pichincha"
+
+
+def rss_pico_mb():
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux informa kilobytes y macOS bytes
+    return pico / 1024 / 1024 if sys.platform == "darwin" else pico / 1024
+
+
+def por_segundo(cantidad, segundos):
+    return round(cantidad / segundos, 1) if segundos > 0 else None
+
+
+def medir_red(cp, servidor_mock, talla, config):
+    paginas = max(1, math.ceil(min(talla, config["max_registros_red"]) / config["tam_pagina"]))
+    servidor, url = servidor_mock.iniciar_servidor(
+        latencia_ms=config["latencia_ms"], paginas=paginas, tam_pagina=config["tam_pagina"],
+        tasa_error=config["tasa_error"],
+    )
+    cp.API_BASE = url
+    cliente = cp.ClienteHTTP(cp.LimitadorTasa(config["peticiones_por_segundo"]), max_conexiones=config["workers"])
+    try:
+        inicio = time.perf_counter()
+        ocids = []
+        errores_paginas = 0
+        for _, _, datos, error in cp.iterar_paginas(ANIO, "", PROVINCIA, cliente, config["workers"]):
+            errores_paginas += error is not None
+            ocids.extend(registro["ocid"] for registro in datos)
+        duracion_paginas = time.perf_counter() - inicio
+        stats_paginas = cliente.estadisticas()
+
+        ocids = ocids[:config["max_ocids"]]
+        inicio = time.perf_counter()
+        montos, fallidos = cp.enriquecer_montos(ocids, cliente, config["workers"])
+        duracion_montos = time.perf_counter() - inicio
+        stats_total = cliente.estadisticas()
+    finally:
+        cliente.cerrar()
+        servidor.shutdown()
+
+    return {
+        "paginas": {
+            "paginas": paginas,
+            "registros": paginas * config["tam_pagina"],
+            "errores": errores_paginas,
+            "segundos": round(duracion_paginas, 3),
+            "paginas_por_segundo": por_segundo(paginas, duracion_paginas),
+            "bytes": stats_paginas["bytes"],
+            "reintentos": stats_paginas["reintentos"],
+            "latencia_media_ms": round(stats_paginas["latencia_media"] * 1000, 2),
+            "latencia_p95_ms": round(stats_paginas["latencia_p95"] * 1000, 2),
+        },
+        "montos": {
+            "ocids": len(ocids),
+            "con_monto": len(montos),
+            "fallidos": fallidos,
+            "segundos": round(duracion_montos, 3),
+            "ocids_por_segundo": por_segundo(len(ocids), duracion_montos),
+            "bytes": stats_total["bytes"] - stats_paginas["bytes"],
+            "reintentos": stats_total["reintentos"] - stats_paginas["reintentos"],
+        },
+    }
+
+
+def construir_figuras(rollups):
+    """Las mismas figuras que arma el dashboard a partir del cubo y los top-k."""
+    import plotly.express as px
+
+    cubo = rollups["cubo"]
+    year_stats = cubo.groupby("year")[["cantidad", "monto_total"]].sum().reset_index()
+    tipo_stats = cubo.groupby("tipo_contratacion", observed=True)[["cantidad", "monto_total"]].sum().reset_index()
+    mes_stats = cubo.groupby("month")[["cantidad", "monto_total"]].sum().reset_index()
+    tipo_mes = cubo.groupby(["month", "tipo_contratacion"], observed=True)["cantidad"].sum().reset_index()
+    tipo_year = cubo.groupby(["year", "tipo_contratacion"], observed=True)[["cantidad", "monto_total"]].sum().reset_index()
+    top_buyers = rollups["top_entidades"].top(10, "entidad_compradora")
+    top_suppliers = rollups["top_proveedores"].top(10, "proveedor")
+
+    return {
+        "anio_cantidad": lambda: px.bar(year_stats, x="year", y="cantidad"),
+        "tipo_monto": lambda: px.bar(tipo_stats, x="tipo_contratacion", y="monto_total"),
+        "tipo_cantidad": lambda: px.bar(tipo_stats, x="tipo_contratacion", y="cantidad"),
+        "mes_cantidad": lambda: px.line(mes_stats, x="month", y="cantidad", markers=True),
+        "mes_monto": lambda: px.line(mes_stats, x="month", y="monto_total", markers=True),
+        "top_entidades": lambda: px.bar(top_buyers, x="cantidad", y="entidad_compradora", orientation="h"),
+        "tipo_pie": lambda: px.pie(tipo_stats, names="tipo_contratacion", values="cantidad"),
+        "mes_tipo": lambda: px.bar(tipo_mes, x="month", y="cantidad", color="tipo_contratacion"),
+        "top_proveedores": lambda: px.bar(top_suppliers, x="cantidad", y="proveedor", orientation="h"),
+        "anio_tipo": lambda: px.line(tipo_year, x="year", y="cantidad", color="tipo_contratacion", markers=True),
+    }
+
+
+def medir_local(cp, servidor_mock, talla):
+    import numpy as np
+    import pandas as pd
+
+    resultado = {}
+    lotes = cp.DirectorioLotes(cp.directorio_trabajo([ANIO], PROVINCIA, "TODAS"))
+    clave = cp.clave_subconsulta(ANIO, PROVINCIA, "TODAS")
+    tiempo_normalizar = tiempo_lotes = 0.0
+    generados = 0
+    indice = 0
+    while generados < talla:
+        cantidad = min(cp.LOTE_REGISTROS, talla - generados)
+        registros = servidor_mock.generar_registros(ANIO, indice, cantidad)
+        inicio = time.perf_counter()
+        df = cp.normalizar_lote(registros, ANIO, PROVINCIA, "TODAS")
+        tiempo_normalizar += time.perf_counter() - inicio
+        inicio = time.perf_counter()
+        lotes.agregar(df, clave)
+        tiempo_lotes += time.perf_counter() - inicio
+        generados += cantidad
+        indice += 1
+    lotes.checkpoint["completas"] = [clave]
+    resultado["normalizacion"] = {
+        "filas": talla, "segundos": round(tiempo_normalizar, 3), "filas_por_segundo": por_segundo(talla, tiempo_normalizar)
+    }
+    resultado["lotes"] = {
+        "filas": lotes.filas, "segundos": round(tiempo_lotes, 3), "filas_por_segundo": por_segundo(talla, tiempo_lotes)
+    }
+
+    ocids = lotes.ocids_unicos()["ocid"]
+    rng = np.random.default_rng(talla)
+    df_montos = pd.DataFrame({
+        "ocid": ocids.to_numpy(),
+        "monto_total": rng.uniform(100, 500000, len(ocids)).round(2),
+        "num_contratos": rng.integers(1, 4, len(ocids)),
+    })
+    df_montos["ocid"] = df_montos["ocid"].astype("string")
+    inicio = time.perf_counter()
+    cp.escribir_almacen(lotes, df_montos)
+    duracion = time.perf_counter() - inicio
+    lotes.eliminar()
+    resultado["almacen"] = {
+        "filas": talla, "segundos": round(duracion, 3), "filas_por_segundo": por_segundo(talla, duracion)
+    }
+
+    inicio = time.perf_counter()
+    df = cp.cargar_desde_almacen([ANIO], PROVINCIA, "TODAS", cp.COLUMNAS_DASHBOARD)
+    memoria_antes = cp.memoria_mb(df)
+    df = cp.aplicar_esquema(df)
+    duracion = time.perf_counter() - inicio
+    resultado["carga_esquema"] = {
+        "filas": len(df), "segundos": round(duracion, 3), "filas_por_segundo": por_segundo(len(df), duracion),
+        "memoria_antes_mb": round(memoria_antes, 2), "memoria_despues_mb": round(cp.memoria_mb(df), 2),
+    }
+    del df
+
+    inicio = time.perf_counter()
+    rollups = cp.construir_rollups([ANIO], PROVINCIA, "TODAS")
+    duracion = time.perf_counter() - inicio
+    resultado["rollups"] = {
+        "filas": talla, "filas_cubo": len(rollups["cubo"]), "segundos": round(duracion, 3),
+        "filas_por_segundo": por_segundo(talla, duracion),
+    }
+
+    figuras = {}
+    for nombre, construir in construir_figuras(rollups).items():
+        inicio = time.perf_counter()
+        contenido = construir().to_json()
+        figuras[nombre] = {"ms": round((time.perf_counter() - inicio) * 1000, 2), "bytes": len(contenido)}
+    resultado["graficos"] = {
+        "figuras": figuras,
+        "ms_total": round(sum(figura["ms"] for figura in figuras.values()), 2),
+        "bytes_total": sum(figura["bytes"] for figura in figuras.values()),
+    }
+    return resultado
+
+
+def medir_talla(talla, config):
+    """Se ejecuta en un proceso aparte: las rutas del caché y del almacén se
+    fijan antes de importar el módulo para no tocar los datos reales."""
+    temporal = tempfile.mkdtemp(prefix="bench_compras_")
+    os.environ["COMPRAS_CACHE_DIR"] = os.path.join(temporal, "cache")
+    os.environ["COMPRAS_ALMACEN_DIR"] = os.path.join(temporal, "almacen")
+    sys.path[:0] = [str(RAIZ), str(DIRECTORIO)]
+    import shutil
+
+    import compras_publicas as cp
+    import servidor_mock
+
+    try:
+        inicio = time.perf_counter()
+        etapas = {}
+        if config["red"]:
+            etapas.update(medir_red(cp, servidor_mock, talla, config))
+        etapas.update(medir_local(cp, servidor_mock, talla))
+        return {
+            "talla": talla,
+            "segundos_total": round(time.perf_counter() - inicio, 3),
+            "rss_pico_mb": round(rss_pico_mb(), 1),
+            "etapas": etapas,
+        }
+    finally:
+        shutil.rmtree(temporal, ignore_errors=True)
+
+
+def metadatos(config):
+    import pandas as pd
+    import plotly
+    import pyarrow
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=RAIZ, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "fecha": datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "pyarrow": pyarrow.__version__,
+        "plotly": plotly.__version__,
+        "plataforma": platform.platform(),
+        "cpus": os.cpu_count(),
+        "configuracion": config,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark por etapas del pipeline de Compras Públicas")
+    parser.add_argument("--tallas", type=int, nargs="+", default=[1000, 10000, 100000, 1000000],
+                        help="Número de releases por corrida")
+    parser.add_argument("--latencia-ms", type=float, default=20, help="Latencia media de la API simulada")
+    parser.add_argument("--tasa-error", type=float, default=0.0, help="Fracción de respuestas 503 del mock")
+    parser.add_argument("--tam-pagina", type=int, default=100, help="Registros por página de search_ocds")
+    parser.add_argument("--max-registros-red", type=int, default=20000,
+                        help="Registros como máximo descargados del mock por corrida")
+    parser.add_argument("--max-ocids", type=int, default=2000, help="Ocids como máximo consultados en /record")
+    parser.add_argument("--workers", type=int, default=6, help="Hilos de descarga")
+    parser.add_argument("--peticiones-por-segundo", type=float, default=1000.0)
+    parser.add_argument("--sin-red", action="store_true", help="Mide solo las etapas locales")
+    parser.add_argument("--salida", type=Path, default=Path("bench_report.json"))
+    args = parser.parse_args(argv)
+
+    config = {
+        "latencia_ms": args.latencia_ms, "tasa_error": args.tasa_error, "tam_pagina": args.tam_pagina,
+        "max_registros_red": args.max_registros_red, "max_ocids": args.max_ocids, "workers": args.workers,
+        "peticiones_por_segundo": args.peticiones_por_segundo, "red": not args.sin_red,
+    }
+    resultados = []
+    for talla in args.tallas:
+        print(f"⏱️ Midiendo {talla:,} releases...")
+        # Un proceso nuevo por tamaño para que el pico de RSS no arrastre corridas anteriores
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            resultado = executor.submit(medir_talla, talla, config).result()
+        resultados.append(resultado)
+        etapas = resultado["etapas"]
+        resumen = [f"normalización {etapas['normalizacion']['filas_por_segundo']:,} filas/s",
+                   f"rollups {etapas['rollups']['filas_por_segundo']:,} filas/s",
+                   f"gráficos {etapas['graficos']['ms_total']} ms",
+                   f"RSS {resultado['rss_pico_mb']} MB"]
+        if "paginas" in etapas:
+            resumen[:0] = [f"{etapas['paginas']['paginas_por_segundo']} páginas/s",
+                           f"{etapas['montos']['ocids_por_segundo']} ocids/s"]
+        print("   " + " · ".join(resumen))
+
+    reporte = {"metadatos": metadatos(config), "resultados": resultados}
+    args.salida.write_text(json.dumps(reporte, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"✅ Reporte escrito en {args.salida}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+"""Servidor local que imita la API de Compras Públicas para medir el pipeline.
+
+Responde a `/PLATAFORMA/api/search_ocds` y `/PLATAFORMA/api/record` con datos
+sintéticos deterministas o, si se indica un directorio de grabaciones, con
+respuestas reales guardadas antes (`search_ocds/*.json` y `record/*.json`).
+La latencia, el número de páginas y la tasa de errores son configurables.
+
+    python benchmarks/servidor_mock.py --puerto 8765 --latencia-ms 50 --paginas 40 --tasa-error 0.02
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+TIPOS = ["Bienes", "Obras", "Servicios", "Consultoría", "Menor Cuantía", "Ínfima Cuantía", "Subasta", "Catálogo"]
+
+
+def generar_registros(anio, page, cantidad, semilla=""):
+    """Registros de /search_ocds con la forma que espera el pipeline."""
+    rng = random.Random(f"{anio}-{page}-{semilla}")
+    registros = []
+    for i in range(cantidad):
+        registros.append({
+            "ocid": f"ocds-mock-{anio}-{semilla}-{page}-{i}",
+            "date": f"{anio}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T{rng.randint(0, 23):02d}:00:00-05:00",
+            "buyerName": f"GAD Municipal {rng.randint(1, 400)}",
+            "internal_type": rng.choice(TIPOS),
+            "single_provider": f"Proveedor {rng.randint(1, 5000)}",
+            "title": f"Proceso {page}-{i}",
+            "description": "Adquisición de bienes y servicios para la institución",
+            "locality": {"region": "Pichincha", "city": "Quito"},
+        })
+    return registros
+
+
+def generar_record(ocid):
+    """Respuesta de /record con uno o varios releases, contratos y adjudicaciones."""
+    rng = random.Random(ocid)
+    releases = []
+    for r in range(rng.randint(1, 3)):
+        contratos = [
+            {"id": f"{ocid}-c{c}", "value": {"amount": round(rng.uniform(100, 500000), 2), "currency": "USD"}}
+            for c in range(rng.randint(0, 3))
+        ]
+        adjudicaciones = [
+            {"id": f"{ocid}-a{a}", "value": {"amount": round(rng.uniform(100, 500000), 2), "currency": "USD"}}
+            for a in range(rng.randint(1, 2))
+        ]
+        releases.append({"id": f"{ocid}-{r}", "contracts": contratos, "awards": adjudicaciones})
+    return {"records": [{"ocid": ocid, "releases": releases}]}
+
+
+class ManejadorMock(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Cabeceras y cuerpo van en escrituras separadas; con Nagle cada respuesta esperaría el ACK retardado (~40 ms)
+    disable_nagle_algorithm = True
+    configuracion = {}
+
+    def log_message(self, formato, *args):
+        pass
+
+    def do_GET(self):
+        config = self.configuracion
+        url = urlparse(self.path)
+        params = {clave: valores[0] for clave, valores in parse_qs(url.query).items()}
+
+        if config["latencia_ms"]:
+            time.sleep(config["latencia_ms"] / 1000 * random.uniform(0.5, 1.5))
+        if random.random() < config["tasa_error"]:
+            self._responder(503, {"error": "Servicio no disponible (simulado)"})
+            return
+
+        if url.path.endswith("/search_ocds"):
+            cuerpo = self._grabacion("search_ocds", params) or self._buscar(params)
+        elif url.path.endswith("/record"):
+            cuerpo = self._grabacion("record", params) or generar_record(params.get("ocid", ""))
+        else:
+            self._responder(404, {"error": "No encontrado"})
+            return
+        self._responder(200, cuerpo)
+
+    def _buscar(self, params):
+        config = self.configuracion
+        page = int(params.get("page", 1))
+        semilla = f"{params.get('buyer', '')}-{params.get('search', '')}"
+        datos = []
+        if page <= config["paginas"]:
+            datos = generar_registros(int(params.get("year", 2024)), page, config["tam_pagina"], semilla)
+        return {"data": datos, "pages": config["paginas"], "total": config["paginas"] * config["tam_pagina"]}
+
+    def _grabacion(self, endpoint, params):
+        grabaciones = self.configuracion.get("grabaciones")
+        if not grabaciones:
+            return None
+        archivos = sorted((Path(grabaciones) / endpoint).glob("*.json"))
+        if not archivos:
+            return None
+        # Cada combinación de parámetros cae siempre en la misma grabación
+        indice = int(hashlib.md5(json.dumps(params, sort_keys=True).encode()).hexdigest(), 16) % len(archivos)
+        return json.loads(archivos[indice].read_text(encoding="utf-8"))
+
+    def _responder(self, estado, cuerpo):
+        contenido = json.dumps(cuerpo, ensure_ascii=False).encode("utf-8")
+        self.send_response(estado)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(contenido)))
+        self.end_headers()
+        self.wfile.write(contenido)
+
+
+def iniciar_servidor(puerto=0, latencia_ms=0, paginas=10, tam_pagina=100, tasa_error=0.0, grabaciones=None):
+    """Arranca el servidor en un hilo y devuelve (servidor, url_base de la API)."""
+    manejador = type("Manejador", (ManejadorMock,), {"configuracion": {
+        "latencia_ms": latencia_ms, "paginas": paginas, "tam_pagina": tam_pagina,
+        "tasa_error": tasa_error, "grabaciones": grabaciones,
+    }})
+    servidor = ThreadingHTTPServer(("127.0.0.1", puerto), manejador)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor, f"http://127.0.0.1:{servidor.server_address[1]}/PLATAFORMA/api"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="API simulada de Compras Públicas para benchmarks")
+    parser.add_argument("--puerto", type=int, default=8765)
+    parser.add_argument("--latencia-ms", type=float, default=0)
+    parser.add_argument("--paginas", type=int, default=10, help="Páginas por consulta de search_ocds")
+    parser.add_argument("--tam-pagina", type=int, default=100, help="Registros por página")
+    parser.add_argument("--tasa-error", type=float, default=0.0, help="Fracción de respuestas 503")
+    parser.add_argument("--grabaciones", type=Path, help="Directorio con respuestas reales grabadas")
+    args = parser.parse_args()
+
+    servidor, url = iniciar_servidor(
+        args.puerto, args.latencia_ms, args.paginas, args.tam_pagina, args.tasa_error, args.grabaciones
+    )
+    print(f"API simulada en {url} (Ctrl+C para terminar)")
+    print(f"Usar con: COMPRAS_API_BASE={url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        servidor.shutdown()
+
+
+if __name__ == "__main__":
+    main()
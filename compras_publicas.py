@@ -0,0 +1,1896 @@
+"""Pipeline de descarga y análisis de compras públicas de Ecuador.
+
+Descarga los procesos de `/search_ocds` y los montos de `/record` de la API
+de datos abiertos de Compras Públicas, los normaliza y los guarda en un
+almacén Parquet particionado que luego lee el dashboard de Streamlit.
+
+También se puede usar sin Streamlit, por ejemplo desde cron:
+
+    python compras_publicas.py --years 2015-2025 --region Guayas --tipo Obras --out salida/
+"""
+import argparse
+import bisect
+import gzip
+import heapq
+import json
+import os
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from itertools import islice, repeat
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:  # opcional: decodificador JSON más rápido
+    orjson = None
+
+API_BASE = os.environ.get("COMPRAS_API_BASE", "https://datosabiertos.compraspublicas.gob.ec/PLATAFORMA/api")
+
+PROVINCIAS = [
+    "Pichincha", "Guayas", "Azuay", "Manabí", "El Oro",
+    "Tungurahua", "Los Ríos", "Imbabura", "Chimborazo", "Cotopaxi",
+    "Loja", "Esmeraldas", "Santo Domingo", "Santa Elena", "Bolívar",
+    "Cañar", "Carchi", "Pastaza", "Morona Santiago", "Napo",
+    "Zamora Chinchipe", "Sucumbíos", "Orellana", "Galápagos"
+]
+TIPOS_CONTRATACION = [
+    "Bienes", "Obras", "Servicios", "Consultoría", "Licitación",
+    "Menor Cuantía", "Ínfima Cuantía", "Subasta", "Catálogo"
+]
+
+# Descarga concurrente de páginas: número de hilos y límite de peticiones por segundo
+MAX_WORKERS_PAGINAS = 6
+PETICIONES_POR_SEGUNDO = 4.0
+# Subconsultas (una por año) que se descargan a la vez
+MAX_SUBCONSULTAS = 4
+
+# Reintentos ante límites de tasa (429) y errores temporales del servidor (5xx)
+MAX_REINTENTOS = 4
+ESTADOS_REINTENTABLES = {429, 500, 502, 503, 504}
+JITTER_REINTENTO = 0.5
+
+# Tiempos de espera en segundos: conexión y lectura por endpoint
+TIMEOUT_CONEXION = 10
+TIMEOUT_LECTURA = {"search_ocds": 30, "record": 15}
+
+# Límites superiores (segundos) del histograma de latencia HTTP
+BUCKETS_LATENCIA = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Latencias que guarda cada cliente (muestreo de reservorio) para estimar el p95 con memoria acotada
+MUESTRA_LATENCIAS = 2048
+
+# Caché local de respuestas: los años cerrados no cambian, el año en curso caduca pronto
+CACHE_DIR = Path(os.environ.get("COMPRAS_CACHE_DIR", ".cache_compras"))
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+TTL_ANIO_ACTUAL = 60 * 60
+
+# Almacén columnar del dataset limpio, particionado por año, provincia y tipo consultado
+ALMACEN_DIR = Path(os.environ.get("COMPRAS_ALMACEN_DIR", "datos_compras"))
+COLUMNAS_ALMACEN = [
+    "ocid", "date", "year", "month", "month_name", "entidad_compradora", "tipo_contratacion",
+    "proveedor", "monto_total", "num_contratos", "title", "description"
+]
+
+# Esquema explícito en memoria: categorías para el texto repetido y enteros compactos con nulos.
+# En disco el texto se guarda como string (Parquet ya lo codifica con diccionario)
+ESQUEMA = {
+    "ocid": "string",
+    "date": "datetime64[ns]",
+    "year": "Int16",
+    "month": "Int8",
+    "month_name": "category",
+    "entidad_compradora": "category",
+    "tipo_contratacion": "category",
+    "proveedor": "category",
+    "provincia": "category",
+    "monto_total": "float64",
+    "num_contratos": "Int32",
+    "title": "string",
+    "description": "string",
+    "anio_consulta": "Int16",
+}
+# Columnas que usa el dashboard; título y descripción solo se leen al exportar
+COLUMNAS_DASHBOARD = [
+    "ocid", "date", "year", "month", "month_name", "entidad_compradora", "tipo_contratacion",
+    "proveedor", "monto_total", "num_contratos", "anio", "provincia"
+]
+
+# Ingesta en streaming: registros por lote y directorio de lotes intermedios en disco
+LOTES_DIR = CACHE_DIR / "lotes"
+LOTE_REGISTROS = 5000
+ZONA_HORARIA = "America/Guayaquil"
+
+# Respuestas de /record que se acumulan antes de extraer sus montos en bloque
+LOTE_MONTOS = 500
+
+# Agregados del dashboard: dimensiones del cubo y tamaño de los resúmenes top-k
+DIMENSIONES_CUBO = ["year", "month", "tipo_contratacion", "provincia"]
+MEDIDAS_CUBO = ["cantidad", "monto_total", "num_contratos"]
+CAPACIDAD_TOP_K = 2000
+# Categorías como máximo por gráfico; el resto se agrupa en "Otros"
+MAX_CATEGORIAS_GRAFICO = 10
+
+# Exportación: extensión y tipo MIME por formato, y directorio de los archivos generados
+FORMATOS_EXPORTACION = {
+    "csv": "text/csv",
+    "csv.gz": "application/gzip",
+    "parquet": "application/vnd.apache.parquet",
+}
+EXPORTACIONES_DIR = CACHE_DIR / "exportaciones"
+
+# Índice local de búsqueda (SQLite FTS5) sobre el almacén y tope de filas por consulta
+INDICE_BUSQUEDA = CACHE_DIR / "busqueda.sqlite"
+LIMITE_RESULTADOS = 500
+
+
+def decodificar_json(contenido):
+    return orjson.loads(contenido) if orjson is not None else json.loads(contenido)
+
+
+rename_map = {
+    "buyerName": "entidad_compradora",
+    "internal_type": "tipo_contratacion",
+    "single_provider": "proveedor"
+}
+
+
+class LimitadorTasa:
+    """Token bucket compartido entre hilos para no saturar la API."""
+
+    def __init__(self, tasa, capacidad=None):
+        self.tasa = tasa
+        self.capacidad = capacidad if capacidad is not None else max(1.0, tasa)
+        self.tokens = self.capacidad
+        self.ultimo = time.monotonic()
+        self.lock = threading.Lock()
+
+    def esperar(self):
+        while True:
+            with self.lock:
+                ahora = time.monotonic()
+                self.tokens = min(self.capacidad, self.tokens + (ahora - self.ultimo) * self.tasa)
+                self.ultimo = ahora
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                espera = (1 - self.tokens) / self.tasa
+            time.sleep(espera)
+
+
+def ttl_para_anio(anio):
+    if anio is not None and int(anio) < datetime.now().year:
+        return None
+    return TTL_ANIO_ACTUAL
+
+
+class CacheRespuestas:
+    """Respuestas de la API guardadas en SQLite (comprimidas con zlib), con
+    caducidad por entrada y desalojo LRU cuando se supera `max_bytes`."""
+
+    def __init__(self, ruta, max_bytes=CACHE_MAX_BYTES):
+        ruta = Path(ruta)
+        ruta.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+        self.conn = sqlite3.connect(ruta, timeout=30, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS respuestas (
+                    clave TEXT PRIMARY KEY,
+                    endpoint TEXT NOT NULL,
+                    payload BLOB NOT NULL,
+                    tamano INTEGER NOT NULL,
+                    creado REAL NOT NULL,
+                    expira REAL,
+                    ultimo_acceso REAL NOT NULL
+                )"""
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_acceso ON respuestas (ultimo_acceso)")
+            self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(tamano), 0) FROM respuestas").fetchone()[0]
+
+    @staticmethod
+    def clave(endpoint, **params):
+        return f"{endpoint}?{json.dumps(params, sort_keys=True, ensure_ascii=False)}"
+
+    def obtener(self, clave):
+        ahora = time.time()
+        with self.lock:
+            fila = self.conn.execute("SELECT payload, expira FROM respuestas WHERE clave = ?", (clave,)).fetchone()
+            if fila is None or (fila[1] is not None and fila[1] < ahora):
+                self.fallos += 1
+                return None
+            with self.conn:
+                self.conn.execute("UPDATE respuestas SET ultimo_acceso = ? WHERE clave = ?", (ahora, clave))
+            self.aciertos += 1
+        return decodificar_json(zlib.decompress(fila[0]))
+
+    def guardar(self, clave, endpoint, datos, ttl=None):
+        payload = zlib.compress(json.dumps(datos, ensure_ascii=False).encode("utf-8"))
+        ahora = time.time()
+        expira = ahora + ttl if ttl is not None else None
+        with self.lock:
+            with self.conn:
+                anterior = self.conn.execute("SELECT tamano FROM respuestas WHERE clave = ?", (clave,)).fetchone()
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO respuestas VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (clave, endpoint, payload, len(payload), ahora, expira, ahora),
+                )
+            self.total_bytes += len(payload) - (anterior[0] if anterior else 0)
+            if self.total_bytes > self.max_bytes:
+                self._desalojar()
+
+    def _desalojar(self):
+        # Primero lo caducado; luego lo menos usado hasta quedar en el 90 % del límite
+        with self.conn:
+            self.conn.execute("DELETE FROM respuestas WHERE expira IS NOT NULL AND expira < ?", (time.time(),))
+            self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(tamano), 0) FROM respuestas").fetchone()[0]
+            objetivo = self.max_bytes * 0.9
+            if self.total_bytes <= objetivo:
+                return
+            claves = []
+            for clave, tamano in self.conn.execute("SELECT clave, tamano FROM respuestas ORDER BY ultimo_acceso"):
+                claves.append((clave,))
+                self.total_bytes -= tamano
+                if self.total_bytes <= objetivo:
+                    break
+            self.conn.executemany("DELETE FROM respuestas WHERE clave = ?", claves)
+
+    def estadisticas(self):
+        with self.lock:
+            return pd.read_sql_query(
+                """SELECT endpoint,
+                          COUNT(*) AS entradas,
+                          SUM(tamano) AS bytes,
+                          SUM(CASE WHEN expira IS NOT NULL AND expira < ? THEN 1 ELSE 0 END) AS caducadas,
+                          datetime(MIN(creado), 'unixepoch', 'localtime') AS mas_antigua
+                   FROM respuestas GROUP BY endpoint""",
+                self.conn,
+                params=(time.time(),),
+            )
+
+    def purgar(self, solo_caducadas=False):
+        with self.lock:
+            with self.conn:
+                if solo_caducadas:
+                    self.conn.execute("DELETE FROM respuestas WHERE expira IS NOT NULL AND expira < ?", (time.time(),))
+                else:
+                    self.conn.execute("DELETE FROM respuestas")
+            self.conn.execute("VACUUM")
+            self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(tamano), 0) FROM respuestas").fetchone()[0]
+
+
+class Metricas:
+    """Contadores, histogramas y tiempos por etapa de una ejecución,
+    compartidos entre hilos. Cada serie se identifica por su nombre y sus
+    etiquetas (p. ej. el endpoint) y se exporta como JSON o como texto de
+    Prometheus."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.contadores = {}
+        self.histogramas = {}
+        self.etapas = {}
+
+    @staticmethod
+    def _clave(nombre, etiquetas):
+        return nombre, tuple(sorted(etiquetas.items()))
+
+    def contar(self, nombre, valor=1, **etiquetas):
+        clave = self._clave(nombre, etiquetas)
+        with self.lock:
+            self.contadores[clave] = self.contadores.get(clave, 0) + valor
+
+    def observar(self, nombre, valor, buckets=BUCKETS_LATENCIA, **etiquetas):
+        clave = self._clave(nombre, etiquetas)
+        with self.lock:
+            histograma = self.histogramas.setdefault(
+                clave, {"buckets": list(buckets), "conteos": [0] * (len(buckets) + 1), "suma": 0.0, "cuenta": 0}
+            )
+            histograma["conteos"][bisect.bisect_left(histograma["buckets"], valor)] += 1
+            histograma["suma"] += valor
+            histograma["cuenta"] += 1
+
+    def registrar_etapa(self, nombre, segundos, filas=0, **etiquetas):
+        clave = self._clave(nombre, etiquetas)
+        with self.lock:
+            etapa = self.etapas.setdefault(clave, {"llamadas": 0, "segundos": 0.0, "filas": 0})
+            etapa["llamadas"] += 1
+            etapa["segundos"] += segundos
+            etapa["filas"] += filas
+
+    @contextmanager
+    def etapa(self, nombre, filas=0, **etiquetas):
+        """Mide el bloque; las filas se pueden corregir al final con `etapa["filas"] = n`."""
+        medicion = {"filas": filas}
+        inicio = time.perf_counter()
+        try:
+            yield medicion
+        finally:
+            self.registrar_etapa(nombre, time.perf_counter() - inicio, medicion["filas"], **etiquetas)
+
+    def agregar(self, otra):
+        """Suma en esta instancia las series de otra (o de su forma en dict)."""
+        datos = otra.a_dict() if isinstance(otra, Metricas) else otra
+        for serie in datos["contadores"]:
+            self.contar(serie["nombre"], serie["valor"], **serie["etiquetas"])
+        for serie in datos["histogramas"]:
+            clave = self._clave(serie["nombre"], serie["etiquetas"])
+            with self.lock:
+                histograma = self.histogramas.setdefault(
+                    clave, {"buckets": serie["buckets"], "conteos": [0] * len(serie["conteos"]), "suma": 0.0, "cuenta": 0}
+                )
+                histograma["conteos"] = [a + b for a, b in zip(histograma["conteos"], serie["conteos"])]
+                histograma["suma"] += serie["suma"]
+                histograma["cuenta"] += serie["cuenta"]
+        for serie in datos["etapas"]:
+            clave = self._clave(serie["nombre"], serie["etiquetas"])
+            with self.lock:
+                etapa = self.etapas.setdefault(clave, {"llamadas": 0, "segundos": 0.0, "filas": 0})
+                for campo in ("llamadas", "segundos", "filas"):
+                    etapa[campo] += serie[campo]
+        return self
+
+    def total(self, nombre):
+        with self.lock:
+            return sum(valor for (serie, _), valor in self.contadores.items() if serie == nombre)
+
+    def histograma(self, nombre):
+        """Conteos por intervalo sumando todas las etiquetas de la serie."""
+        with self.lock:
+            series = [histograma for (serie, _), histograma in self.histogramas.items() if serie == nombre]
+        if not series:
+            return pd.DataFrame(columns=["hasta", "cantidad"])
+        limites = [f"≤ {limite:g} s" for limite in series[0]["buckets"]] + [f"> {series[0]['buckets'][-1]:g} s"]
+        return pd.DataFrame({"hasta": limites, "cantidad": [sum(conteos) for conteos in zip(*(h["conteos"] for h in series))]})
+
+    def tabla_etapas(self):
+        filas = [
+            {
+                "etapa": serie["nombre"] + "".join(f" · {valor}" for valor in serie["etiquetas"].values()),
+                "llamadas": serie["llamadas"],
+                "segundos": round(serie["segundos"], 3),
+                "filas": serie["filas"],
+                "filas_por_segundo": serie["filas_por_segundo"],
+            }
+            for serie in self.a_dict()["etapas"]
+        ]
+        return pd.DataFrame(filas, columns=["etapa", "llamadas", "segundos", "filas", "filas_por_segundo"])
+
+    def a_dict(self):
+        with self.lock:
+            return {
+                "contadores": [
+                    {"nombre": nombre, "etiquetas": dict(etiquetas), "valor": valor}
+                    for (nombre, etiquetas), valor in sorted(self.contadores.items())
+                ],
+                "histogramas": [
+                    {"nombre": nombre, "etiquetas": dict(etiquetas), **histograma,
+                     "buckets": list(histograma["buckets"]), "conteos": list(histograma["conteos"])}
+                    for (nombre, etiquetas), histograma in sorted(self.histogramas.items())
+                ],
+                "etapas": [
+                    {"nombre": nombre, "etiquetas": dict(etiquetas), **etapa,
+                     "filas_por_segundo": round(etapa["filas"] / etapa["segundos"], 1) if etapa["filas"] and etapa["segundos"] else None}
+                    for (nombre, etiquetas), etapa in sorted(self.etapas.items())
+                ],
+            }
+
+    def exportar_json(self):
+        return json.dumps(self.a_dict(), ensure_ascii=False, indent=2)
+
+    def exportar_prometheus(self, prefijo="compras_"):
+        """Formato de exposición de texto de Prometheus (para un textfile collector o un push gateway)."""
+        datos = self.a_dict()
+        lineas = []
+        tipos = set()
+
+        def serie(nombre, tipo, etiquetas, valor, sufijo=""):
+            if nombre not in tipos:
+                tipos.add(nombre)
+                lineas.append(f"# TYPE {prefijo}{nombre} {tipo}")
+            texto = ",".join(f'{clave}="{_escapar_etiqueta(valor_etq)}"' for clave, valor_etq in etiquetas.items())
+            lineas.append(f"{prefijo}{nombre}{sufijo}{{{texto}}} {valor}" if texto else f"{prefijo}{nombre}{sufijo} {valor}")
+
+        for contador in datos["contadores"]:
+            serie(contador["nombre"], "counter", contador["etiquetas"], contador["valor"])
+        for histograma in datos["histogramas"]:
+            acumulado = 0
+            for limite, conteo in zip([f"{limite:g}" for limite in histograma["buckets"]] + ["+Inf"], histograma["conteos"]):
+                acumulado += conteo
+                serie(histograma["nombre"], "histogram", {**histograma["etiquetas"], "le": limite}, acumulado, "_bucket")
+            serie(histograma["nombre"], "histogram", histograma["etiquetas"], histograma["suma"], "_sum")
+            serie(histograma["nombre"], "histogram", histograma["etiquetas"], histograma["cuenta"], "_count")
+        # Las muestras de una misma familia deben ir juntas
+        for campo in ("segundos", "llamadas", "filas"):
+            for etapa in datos["etapas"]:
+                etiquetas = {"etapa": etapa["nombre"], **etapa["etiquetas"]}
+                serie(f"etapa_{campo}_total", "counter", etiquetas, round(etapa[campo], 6))
+        return "\n".join(lineas) + "\n"
+
+
+def _escapar_etiqueta(valor):
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def medir(metricas, nombre, filas=0, **etiquetas):
+    """`metricas.etapa(...)` si hay registro de métricas; si no, no mide nada."""
+    return metricas.etapa(nombre, filas, **etiquetas) if metricas is not None else nullcontext({"filas": filas})
+
+
+class RetryConJitter(Retry):
+    # Backoff exponencial de urllib3 más un componente aleatorio, para que los hilos no reintenten a la vez
+    def get_backoff_time(self):
+        espera = super().get_backoff_time()
+        return espera + random.uniform(0, JITTER_REINTENTO) if espera > 0 else 0
+
+
+class ClienteHTTP:
+    """Sesión HTTP compartida por las descargas de páginas y de montos: pool
+    de conexiones persistentes, respuestas comprimidas, reintentos con
+    backoff y contadores de peticiones, bytes, reintentos y latencia. Si se
+    pasa un registro de `Metricas`, cada petición se anota además por endpoint."""
+
+    def __init__(self, limitador, max_conexiones=MAX_WORKERS_PAGINAS, reintentos=MAX_REINTENTOS,
+                 timeout_conexion=TIMEOUT_CONEXION, timeout_lectura=TIMEOUT_LECTURA, metricas=None):
+        self.limitador = limitador
+        self.metricas = metricas
+        self.timeout_conexion = timeout_conexion
+        self.timeout_lectura = timeout_lectura
+        retry = RetryConJitter(
+            total=reintentos,
+            backoff_factor=0.5,
+            status_forcelist=sorted(ESTADOS_REINTENTABLES),
+            allowed_methods=frozenset({"GET"}),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adaptador = HTTPAdapter(pool_connections=2, pool_maxsize=max_conexiones, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adaptador)
+        self.session.mount("http://", adaptador)
+        self.session.headers.update({"Accept": "application/json", "Accept-Encoding": "gzip, deflate"})
+
+        self.lock = threading.Lock()
+        self.peticiones = 0
+        self.bytes_descargados = 0
+        self.reintentos = 0
+        self.suma_latencias = 0.0
+        self.muestra_latencias = []
+
+    def obtener_json(self, endpoint, params):
+        self.limitador.esperar()
+        inicio = time.perf_counter()
+        response = self.session.get(
+            f"{API_BASE}/{endpoint}", params=params,
+            timeout=(self.timeout_conexion, self.timeout_lectura.get(endpoint, 30)),
+        )
+        contenido = response.content
+        latencia = time.perf_counter() - inicio
+        historial = response.raw.retries.history if getattr(response.raw, "retries", None) else ()
+        # Content-Length es el tamaño comprimido que viajó por la red
+        tamano = int(response.headers.get("Content-Length") or len(contenido))
+        with self.lock:
+            self.peticiones += 1
+            self.bytes_descargados += tamano
+            self.reintentos += len(historial)
+            self.suma_latencias += latencia
+            # Cada petición queda en la muestra con probabilidad MUESTRA_LATENCIAS / peticiones
+            if len(self.muestra_latencias) < MUESTRA_LATENCIAS:
+                self.muestra_latencias.append(latencia)
+            else:
+                posicion = random.randrange(self.peticiones)
+                if posicion < MUESTRA_LATENCIAS:
+                    self.muestra_latencias[posicion] = latencia
+        if self.metricas is not None:
+            self.metricas.contar("http_peticiones_total", endpoint=endpoint, estado=response.status_code)
+            self.metricas.contar("http_bytes_total", tamano, endpoint=endpoint)
+            self.metricas.contar("http_reintentos_total", len(historial), endpoint=endpoint)
+            self.metricas.observar("http_latencia_segundos", latencia, endpoint=endpoint)
+        response.raise_for_status()
+        return decodificar_json(contenido)
+
+    def estadisticas(self):
+        with self.lock:
+            return {
+                "peticiones": self.peticiones,
+                "bytes": self.bytes_descargados,
+                "reintentos": self.reintentos,
+                "latencia_media": self.suma_latencias / self.peticiones if self.peticiones else 0.0,
+                "latencia_p95": float(np.quantile(self.muestra_latencias, 0.95)) if self.peticiones else 0.0,
+            }
+
+    def cerrar(self):
+        self.session.close()
+
+
+def obtener_json_cacheado(endpoint, params, cliente, cache=None, ttl=None):
+    if cache is None:
+        return cliente.obtener_json(endpoint, params)
+    clave = CacheRespuestas.clave(endpoint, **params)
+    datos = cache.obtener(clave)
+    if cliente.metricas is not None:
+        cliente.metricas.contar("cache_aciertos_total" if datos is not None else "cache_fallos_total", endpoint=endpoint)
+    if datos is None:
+        datos = cliente.obtener_json(endpoint, params)
+        cache.guardar(clave, endpoint, datos, ttl)
+    return datos
+
+
+def descargar_pagina(params, page, cliente, cache=None):
+    return obtener_json_cacheado(
+        "search_ocds", {**params, "page": page}, cliente, cache, ttl_para_anio(params["year"])
+    )
+
+
+def iterar_descargas(params, pages, cliente, max_workers=MAX_WORKERS_PAGINAS, cache=None):
+    """Genera (page, datos, error) en el orden de `pages` manteniendo una
+    ventana acotada de descargas en curso, de modo que nunca hay más de unas
+    pocas páginas en memoria."""
+    orden = list(pages)
+    ventana = max_workers * 2
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pendientes = {}
+        siguiente = 0
+        for idx, page in enumerate(orden):
+            while siguiente < len(orden) and len(pendientes) < ventana:
+                pendientes[siguiente] = executor.submit(descargar_pagina, params, orden[siguiente], cliente, cache)
+                siguiente += 1
+            futuro = pendientes.pop(idx)
+            try:
+                yield page, futuro.result().get("data", []), None
+            except Exception as e:
+                yield page, [], e
+
+
+def iterar_paginas(current_year, search_term, region, cliente, max_workers=MAX_WORKERS_PAGINAS, cache=None, desde=1, reintentar=()):
+    """Genera (page, total_pages, datos, error) en orden de página. Tras la
+    primera página, que indica `pages`, el resto se descarga con
+    `iterar_descargas`. Para reanudar se indica la primera página pendiente (`desde`) y
+    las páginas que fallaron antes (`reintentar`), que van primero."""
+    params = {"year": current_year, "search": search_term}
+    if region != "TODAS":
+        params["buyer"] = region
+
+    primera = descargar_pagina(params, 1, cliente, cache)
+    total_pages = primera.get("pages", 1) or 1
+    if desde <= 1 or 1 in reintentar:
+        yield 1, total_pages, primera.get("data", []), None
+    del primera
+
+    orden = [page for page in sorted(reintentar) if page > 1] + list(range(max(desde, 2), total_pages + 1))
+    for page, datos, error in iterar_descargas(params, orden, cliente, max_workers, cache):
+        yield page, total_pages, datos, error
+
+
+class EstadoSync:
+    """Último estado sincronizado por (año, provincia, tipo), los registros
+    acumulados de cada combinación, deduplicados por ocid, y los montos ya
+    consultados de cada ocid, para no volver a pedir su /record mientras el
+    registro no cambie."""
+
+    def __init__(self, ruta):
+        ruta = Path(ruta)
+        ruta.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(ruta, timeout=30, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS sync_estado (
+                    anio INTEGER NOT NULL,
+                    region TEXT NOT NULL,
+                    tipo TEXT NOT NULL,
+                    watermark TEXT NOT NULL,
+                    paginas INTEGER NOT NULL,
+                    actualizado REAL NOT NULL,
+                    PRIMARY KEY (anio, region, tipo)
+                )"""
+            )
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS sync_registros (
+                    anio INTEGER NOT NULL,
+                    region TEXT NOT NULL,
+                    tipo TEXT NOT NULL,
+                    ocid TEXT NOT NULL,
+                    fecha TEXT,
+                    payload TEXT NOT NULL,
+                    PRIMARY KEY (anio, region, tipo, ocid)
+                )"""
+            )
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS sync_montos (
+                    ocid TEXT PRIMARY KEY,
+                    monto_total REAL,
+                    num_contratos INTEGER
+                )"""
+            )
+
+    def obtener(self, anio, region, tipo):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT watermark, paginas FROM sync_estado WHERE anio = ? AND region = ? AND tipo = ?",
+                (anio, region, tipo),
+            ).fetchone()
+
+    def fusionar(self, anio, region, tipo, registros):
+        """Guarda los registros nuevos o con contenido distinto al guardado y
+        olvida el monto de esos ocid. Devuelve cuántos se guardaron."""
+        filas = {
+            registro["ocid"]: (registro.get("date"), json.dumps(registro, ensure_ascii=False))
+            for registro in registros
+            if registro.get("ocid")
+        }
+        ocids = list(filas)
+        with self.lock, self.conn:
+            previos = {}
+            for inicio in range(0, len(ocids), 500):
+                parte = ocids[inicio:inicio + 500]
+                previos.update(self.conn.execute(
+                    f"""SELECT ocid, payload FROM sync_registros
+                        WHERE anio = ? AND region = ? AND tipo = ? AND ocid IN ({', '.join('?' * len(parte))})""",
+                    (anio, region, tipo, *parte),
+                ))
+            cambiados = [
+                (anio, region, tipo, ocid, fecha, payload)
+                for ocid, (fecha, payload) in filas.items()
+                if previos.get(ocid) != payload
+            ]
+            self.conn.executemany("INSERT OR REPLACE INTO sync_registros VALUES (?, ?, ?, ?, ?, ?)", cambiados)
+            self.conn.executemany("DELETE FROM sync_montos WHERE ocid = ?", [(fila[3],) for fila in cambiados])
+        return len(cambiados)
+
+    def montos(self, anio, region, tipo):
+        # Montos guardados de los registros de la combinación; monto_total nulo = consultado sin monto
+        with self.lock:
+            return pd.read_sql_query(
+                """SELECT m.ocid, m.monto_total, m.num_contratos
+                   FROM sync_registros r JOIN sync_montos m USING (ocid)
+                   WHERE r.anio = ? AND r.region = ? AND r.tipo = ?""",
+                self.conn, params=(anio, region, tipo),
+            )
+
+    def guardar_montos(self, ocids, df_montos):
+        sin_monto = set(ocids).difference(df_montos["ocid"])
+        filas = list(zip(df_montos["ocid"].tolist(), df_montos["monto_total"].tolist(), df_montos["num_contratos"].tolist()))
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO sync_montos VALUES (?, ?, ?)", filas + [(ocid, None, None) for ocid in sin_monto]
+            )
+
+    def iterar_registros(self, anio, region, tipo, tamano=LOTE_REGISTROS):
+        with self.lock:
+            cursor = self.conn.execute(
+                "SELECT payload FROM sync_registros WHERE anio = ? AND region = ? AND tipo = ? ORDER BY fecha DESC",
+                (anio, region, tipo),
+            )
+            filas = cursor.fetchmany(tamano)
+        while filas:
+            yield [json.loads(fila[0]) for fila in filas]
+            with self.lock:
+                filas = cursor.fetchmany(tamano)
+
+    def marcar(self, anio, region, tipo, paginas):
+        with self.lock, self.conn:
+            watermark = self.conn.execute(
+                "SELECT MAX(fecha) FROM sync_registros WHERE anio = ? AND region = ? AND tipo = ?",
+                (anio, region, tipo),
+            ).fetchone()[0]
+            self.conn.execute(
+                "INSERT OR REPLACE INTO sync_estado VALUES (?, ?, ?, ?, ?, ?)",
+                (anio, region, tipo, watermark or "", paginas, time.time()),
+            )
+
+    def resumen(self):
+        with self.lock:
+            return pd.read_sql_query(
+                """SELECT e.anio, e.region, e.tipo, e.watermark, COUNT(r.ocid) AS registros,
+                          datetime(e.actualizado, 'unixepoch', 'localtime') AS actualizado
+                   FROM sync_estado e
+                   LEFT JOIN sync_registros r USING (anio, region, tipo)
+                   GROUP BY e.anio, e.region, e.tipo
+                   ORDER BY e.anio DESC""",
+                self.conn,
+            )
+
+
+def sincronizar_anio(current_year, search_term, region, tipo, cliente, estado, max_workers=MAX_WORKERS_PAGINAS, progreso=None):
+    """Descarga solo lo nuevo desde la última sincronización del año.
+
+    Se recorren las primeras páginas hasta encontrar una en la que todos los
+    registros son anteriores a la marca de agua, y además las páginas que no
+    existían en la sincronización anterior, por si la API ordena de forma
+    ascendente. Cada página se fusiona en `estado` en cuanto llega, así que
+    en memoria solo está la ventana de descargas en curso. Devuelve los
+    errores y el número de registros nuevos o actualizados; los registros
+    acumulados se leen después por lotes con `estado.iterar_registros`."""
+    params = {"year": current_year, "search": search_term}
+    if region != "TODAS":
+        params["buyer"] = region
+
+    primera = descargar_pagina(params, 1, cliente)
+    total_pages = primera.get("pages", 1) or 1
+    previo = estado.obtener(current_year, region, tipo)
+    errores = []
+
+    if previo is None:
+        nuevos = estado.fusionar(current_year, region, tipo, primera.get("data", []))
+        cola = range(2, total_pages + 1)
+    else:
+        watermark, paginas_previas = previo
+
+        def recientes(datos):
+            return [registro for registro in datos if str(registro.get("date") or "") > watermark]
+
+        datos = primera.get("data", [])
+        nuevos = estado.fusionar(current_year, region, tipo, recientes(datos))
+        page = 1
+        while datos and len(recientes(datos)) == len(datos) and page < total_pages:
+            page += 1
+            if progreso:
+                progreso(page, total_pages, nuevos)
+            try:
+                datos = descargar_pagina(params, page, cliente).get("data", [])
+            except Exception as e:
+                errores.append((page, e))
+                break
+            nuevos += estado.fusionar(current_year, region, tipo, recientes(datos))
+        cola = range(max(page + 1, paginas_previas), total_pages + 1)
+    del primera
+
+    for page, datos, error in iterar_descargas(params, cola, cliente, max_workers):
+        if error is not None:
+            errores.append((page, error))
+        else:
+            nuevos += estado.fusionar(current_year, region, tipo, datos)
+        if progreso:
+            progreso(page, total_pages, nuevos)
+
+    # Con páginas fallidas la marca de agua no avanza, para reintentarlas en la próxima sincronización
+    if not errores:
+        estado.marcar(current_year, region, tipo, total_pages)
+    return errores, nuevos
+
+
+def extraer_montos(respuestas):
+    """Montos de un lote de respuestas de /record ({ocid: respuesta}).
+
+    Los contratos y adjudicaciones de todos los releases se aplanan en una
+    sola pasada a dos tablas (ocid, id, monto) y el resto se calcula por
+    columnas: un contrato repetido en varios releases cuenta una sola vez,
+    con su valor más reciente. El monto es la suma de los contratos con
+    valor (o de las adjudicaciones si esa suma es cero) y `num_contratos`
+    cuántos contratos tienen valor, al menos 1. Los ocid sin releases no
+    aparecen; las partes con otra forma (releases, contratos o valores que
+    no son objetos) se ignoran, así que una respuesta malformada cuenta
+    como consultada y sin monto en lugar de hacer fallar el lote."""
+    ocids = []
+    contratos = []
+    adjudicaciones = []
+    for ocid, respuesta in respuestas.items():
+        records = respuesta.get("records") if isinstance(respuesta, dict) else None
+        record = records[0] if isinstance(records, list) and records else None
+        releases = record.get("releases") if isinstance(record, dict) else None
+        releases = [release for release in releases if isinstance(release, dict)] if isinstance(releases, list) else []
+        if not releases:
+            continue
+        ocids.append(ocid)
+        for release in releases:
+            for campo, filas in (("contracts", contratos), ("awards", adjudicaciones)):
+                elementos = release.get(campo)
+                if not isinstance(elementos, list):
+                    continue
+                # La posición dentro del release identifica a los elementos sin id
+                for posicion, elemento in enumerate(elementos):
+                    if not isinstance(elemento, dict):
+                        continue
+                    identificador = elemento.get("id", posicion)
+                    if not isinstance(identificador, (str, int)):
+                        identificador = str(identificador)
+                    valor = elemento.get("value")
+                    monto = valor.get("amount") if isinstance(valor, dict) else None
+                    if not isinstance(monto, (str, int, float)) or isinstance(monto, bool):
+                        monto = None
+                    filas.append((ocid, identificador, monto))
+
+    def sin_repetidos(filas):
+        columnas = list(zip(*filas)) or [(), (), ()]
+        tabla = pd.DataFrame({"ocid": columnas[0], "id": columnas[1], "monto": columnas[2]})
+        tabla["monto"] = pd.to_numeric(tabla["monto"], errors="coerce")
+        return tabla.dropna(subset=["monto"]).drop_duplicates(subset=["ocid", "id"], keep="last")
+
+    indice = pd.Index(ocids, name="ocid")
+    por_contrato = sin_repetidos(contratos).groupby("ocid")["monto"].agg(["sum", "size"]).reindex(indice, fill_value=0)
+    por_adjudicacion = sin_repetidos(adjudicaciones).groupby("ocid")["monto"].sum().reindex(indice, fill_value=0)
+    resultado = pd.DataFrame({
+        "monto_total": por_contrato["sum"].where(por_contrato["sum"] != 0, por_adjudicacion).astype("float64"),
+        "num_contratos": por_contrato["size"].clip(lower=1).astype("int64"),
+    }, index=indice).reset_index()
+    resultado["ocid"] = resultado["ocid"].astype("string")
+    return resultado
+
+
+def obtener_record(ocid, anio, cliente, cache=None):
+    return obtener_json_cacheado("record", {"ocid": ocid}, cliente, cache, ttl_para_anio(anio))
+
+
+def enriquecer_montos(ocids, cliente, max_workers=MAX_WORKERS_PAGINAS, progreso=None, cache=None, anio_por_ocid=None,
+                      al_obtener=None, detener=None, tamano_lote=LOTE_MONTOS):
+    """Consulta /record para cada ocid con un pool de hilos que comparte el
+    cliente HTTP y extrae los montos por lotes de `tamano_lote` respuestas.
+    Como en `iterar_paginas`, solo hay unas pocas consultas en vuelo a la
+    vez, así que la memoria no crece con el número de ocid.
+    Devuelve los montos obtenidos (DataFrame) y el número de fallos.
+
+    Si se pasa `al_obtener(ocids, df_montos)`, se llama con cada lote (los
+    ocid consultados, tengan o no monto, y los montos extraídos) en lugar de
+    acumularlos; `detener` es un threading.Event que cancela las consultas
+    pendientes."""
+    anio_por_ocid = anio_por_ocid or {}
+    montos = []
+    respuestas = {}
+    fallidos = 0
+
+    def procesar_lote():
+        with medir(cliente.metricas, "extraccion_montos", len(respuestas)):
+            df_lote = extraer_montos(respuestas)
+        if al_obtener is not None:
+            al_obtener(list(respuestas), df_lote)
+        else:
+            montos.append(df_lote)
+        respuestas.clear()
+
+    ventana = max_workers * 2
+    por_consultar = iter(ocids)
+    pendientes = {}
+    hechos = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            for ocid in islice(por_consultar, ventana - len(pendientes)):
+                pendientes[executor.submit(obtener_record, ocid, anio_por_ocid.get(ocid), cliente, cache)] = ocid
+            if not pendientes or (detener is not None and detener.is_set()):
+                break
+            listos, _ = wait(pendientes, return_when=FIRST_COMPLETED)
+            for futuro in listos:
+                # Cada futuro retiene su respuesta: se suelta en cuanto se lee
+                ocid = pendientes.pop(futuro)
+                try:
+                    respuestas[ocid] = futuro.result()
+                except Exception:
+                    fallidos += 1
+                hechos += 1
+                if len(respuestas) >= tamano_lote:
+                    procesar_lote()
+                if progreso:
+                    progreso(hechos, len(ocids))
+            del listos
+    if respuestas:
+        procesar_lote()
+    return (pd.concat(montos, ignore_index=True) if montos else extraer_montos({})), fallidos
+
+
+def planificar_consultas(years, region, tipo):
+    """Divide una consulta en subconsultas independientes (año, provincia,
+    tipo), una por año y con la misma provincia y tipo: así se piden a la
+    API exactamente los mismos registros que la consulta original ("TODAS"
+    no se reparte en provincias ni tipos, porque esas búsquedas por texto
+    no cubren a todos los compradores ni procesos). Cada subconsulta se
+    descarga, reintenta, cachea y sincroniza por separado, sus páginas se
+    piden en paralelo, y corresponde a una partición del almacén."""
+    return [(anio, region, tipo) for anio in years]
+
+
+def clave_subconsulta(anio, provincia, tipo):
+    return f"{anio}|{provincia}|{tipo}"
+
+
+def ruta_particion(anio, provincia, tipo):
+    return ALMACEN_DIR / f"anio={anio}" / f"provincia={provincia}" / f"consulta={tipo}" / "part-0.parquet"
+
+
+def normalizar_lote(registros, anio_consulta, provincia, consulta, metricas=None):
+    """Convierte un lote de registros crudos al esquema del almacén, siempre
+    con las mismas columnas y tipos para poder escribir lotes sucesivos."""
+    df = pd.DataFrame(registros).rename(columns=rename_map)
+    for columna in COLUMNAS_ALMACEN:
+        if columna not in df.columns:
+            df[columna] = None
+    df = df[df["ocid"].notna()]
+
+    with medir(metricas, "to_datetime", len(df)):
+        fechas = pd.to_datetime(df["date"], errors="coerce", utc=True)
+        df["date"] = fechas.dt.tz_convert(ZONA_HORARIA).dt.tz_localize(None)
+    df["year"] = df["date"].dt.year.astype(ESQUEMA["year"])
+    df["month"] = df["date"].dt.month.astype(ESQUEMA["month"])
+    df["month_name"] = df["date"].dt.strftime('%B').astype("string")
+    for columna in ("ocid", "entidad_compradora", "tipo_contratacion", "proveedor", "title", "description"):
+        df[columna] = df[columna].astype("string")
+    df["anio_consulta"] = pd.Series(anio_consulta, index=df.index, dtype=ESQUEMA["anio_consulta"])
+    df["provincia"] = provincia
+    df["consulta"] = consulta
+    columnas = [columna for columna in COLUMNAS_ALMACEN if columna not in ("monto_total", "num_contratos")]
+    return df[columnas + ["anio_consulta", "provincia", "consulta"]]
+
+
+def descartar_vistos(df, vistos):
+    """Quita los ocid de `vistos` y los repetidos del propio lote (como
+    drop_duplicates con keep="first") y añade los nuevos a `vistos`."""
+    # Series.isin(set) convierte el conjunto entero en cada llamada; con muchos lotes eso es cuadrático.
+    # La máscara es un array booleano: una lista vacía se tomaría como selección de columnas
+    nuevos = np.fromiter((ocid not in vistos for ocid in df["ocid"].tolist()), dtype=bool, count=len(df))
+    df = df.loc[nuevos].drop_duplicates(subset=["ocid"], keep="first")
+    vistos.update(df["ocid"].tolist())
+    return df
+
+
+class DirectorioLotes:
+    """Lotes normalizados escritos en disco como archivos Parquet sucesivos.
+    Los ocid ya vistos en la misma subconsulta se descartan al agregar, igual
+    que drop_duplicates con keep="first"; entre subconsultas la deduplicación
+    se hace al leer el almacén, para que cada partición quede completa.
+
+    El directorio guarda además un punto de control (checkpoint.json con las
+    páginas procesadas por año) y los montos ya consultados (montos.sqlite),
+    para poder reanudar una descarga interrumpida con `reanudar=True`."""
+
+    def __init__(self, directorio, reanudar=False, metricas=None):
+        self.lock = threading.RLock()
+        self.metricas = metricas
+        self.directorio = Path(directorio)
+        self.ruta_checkpoint = self.directorio / "checkpoint.json"
+        if not reanudar:
+            shutil.rmtree(self.directorio, ignore_errors=True)
+        self.directorio.mkdir(parents=True, exist_ok=True)
+
+        self.checkpoint = {
+            "parametros": {}, "archivos": [], "paginas": {}, "fallidas": {}, "registros": {}, "completas": []
+        }
+        if self.ruta_checkpoint.exists():
+            self.checkpoint.update(json.loads(self.ruta_checkpoint.read_text(encoding="utf-8")))
+        self.archivos = [self.directorio / nombre for nombre in self.checkpoint["archivos"]]
+        # Un lote escrito después del último punto de control se vuelve a descargar
+        for ruta in self.directorio.glob("lote-*.parquet"):
+            if ruta not in self.archivos:
+                ruta.unlink()
+
+        self.vistos = {}
+        self.filas = 0
+        for lote in self.iterar(["ocid", "anio_consulta", "provincia", "consulta"]):
+            for clave, grupo in lote.groupby(["anio_consulta", "provincia", "consulta"]):
+                self.vistos.setdefault(clave_subconsulta(*clave), set()).update(grupo["ocid"])
+            self.filas += len(lote)
+
+        self.conn_montos = sqlite3.connect(self.directorio / "montos.sqlite", check_same_thread=False)
+        with self.conn_montos:
+            self.conn_montos.execute("PRAGMA journal_mode=WAL")
+            self.conn_montos.execute("PRAGMA synchronous=NORMAL")
+            self.conn_montos.execute(
+                "CREATE TABLE IF NOT EXISTS montos (ocid TEXT PRIMARY KEY, monto_total REAL, num_contratos INTEGER)"
+            )
+
+    def agregar(self, df, clave):
+        with self.lock:
+            vistos = self.vistos.setdefault(clave, set())
+            with medir(self.metricas, "deduplicacion", len(df)):
+                df = descartar_vistos(df, vistos)
+            if df.empty:
+                return 0
+            ruta = self.directorio / f"lote-{len(self.archivos):06d}.parquet"
+            df.to_parquet(ruta, engine="pyarrow", index=False)
+            self.archivos.append(ruta)
+            self.checkpoint["archivos"].append(ruta.name)
+            self.filas += len(df)
+            return len(df)
+
+    def guardar_checkpoint(self):
+        with self.lock:
+            temporal = self.ruta_checkpoint.with_suffix(".tmp")
+            temporal.write_text(json.dumps(self.checkpoint, ensure_ascii=False), encoding="utf-8")
+            temporal.replace(self.ruta_checkpoint)
+
+    def iterar(self, columnas=None):
+        for ruta in self.archivos:
+            yield pd.read_parquet(ruta, engine="pyarrow", columns=columnas)
+
+    def ocids_unicos(self):
+        # Un mismo ocid puede aparecer en varias subconsultas; su monto se consulta una sola vez
+        df_ocids = pd.concat(self.iterar(["ocid", "anio_consulta"]), ignore_index=True)
+        return df_ocids.drop_duplicates(subset=["ocid"], keep="first")
+
+    def guardar_montos(self, ocids, df_montos):
+        # Los ocid sin monto también se anotan, para no volver a consultarlos al reanudar
+        sin_monto = set(ocids).difference(df_montos["ocid"])
+        filas = list(zip(df_montos["ocid"].tolist(), df_montos["monto_total"].tolist(), df_montos["num_contratos"].tolist()))
+        with self.conn_montos:
+            self.conn_montos.executemany(
+                "INSERT OR REPLACE INTO montos VALUES (?, ?, ?)", filas + [(ocid, None, None) for ocid in sin_monto]
+            )
+
+    def ocids_consultados(self):
+        return {fila[0] for fila in self.conn_montos.execute("SELECT ocid FROM montos")}
+
+    def claves_sin_montos(self):
+        # Subconsultas con algún ocid cuyo /record no se pudo consultar
+        consultados = self.ocids_consultados()
+        claves = set()
+        for lote in self.iterar(["ocid", "anio_consulta", "provincia", "consulta"]):
+            faltan = np.fromiter((ocid not in consultados for ocid in lote["ocid"].tolist()), dtype=bool, count=len(lote))
+            for clave in lote.loc[faltan, ["anio_consulta", "provincia", "consulta"]].drop_duplicates().itertuples(index=False):
+                claves.add(clave_subconsulta(*clave))
+        return claves
+
+    def montos(self):
+        df_montos = pd.read_sql_query(
+            "SELECT ocid, monto_total, num_contratos FROM montos WHERE monto_total IS NOT NULL", self.conn_montos
+        )
+        df_montos["ocid"] = df_montos["ocid"].astype("string")
+        return df_montos
+
+    def eliminar(self):
+        self.conn_montos.close()
+        shutil.rmtree(self.directorio, ignore_errors=True)
+
+
+def temporal_particion(ruta):
+    # Nombre único por escritura: dos descargas (o el CLI y el dashboard) pueden escribir la misma partición a la vez
+    ruta.parent.mkdir(parents=True, exist_ok=True)
+    descriptor, temporal = tempfile.mkstemp(dir=ruta.parent, prefix=".part-", suffix=".tmp")
+    os.close(descriptor)
+    return Path(temporal)
+
+
+def escribir_almacen(lotes, df_montos, claves=None):
+    """Une los montos a cada lote y lo añade a la partición de su subconsulta.
+    Solo se publican las subconsultas de `claves` (por defecto, las completas
+    del punto de control). Cada partición se escribe en un temporal propio
+    que se renombra al terminar, para no dejar particiones a medias. Las
+    subconsultas sin resultados quedan como particiones vacías, para no
+    volver a pedirlas."""
+    claves = set(lotes.checkpoint["completas"] if claves is None else claves)
+    escritores = {}
+    temporales = {}
+    esquema = None
+    try:
+        for lote in lotes.iterar():
+            with medir(lotes.metricas, "merge_montos", len(lote)):
+                lote = lote.merge(df_montos, on="ocid", how="left")
+            lote["monto_total"] = lote["monto_total"].fillna(0).astype("float64")
+            lote["num_contratos"] = lote["num_contratos"].fillna(0).astype(ESQUEMA["num_contratos"])
+            for (anio, provincia, tipo), grupo in lote.groupby(["anio_consulta", "provincia", "consulta"]):
+                if clave_subconsulta(anio, provincia, tipo) not in claves:
+                    continue
+                ruta = ruta_particion(anio, provincia, tipo)
+                tabla = pa.Table.from_pandas(grupo[COLUMNAS_ALMACEN], preserve_index=False)
+                if ruta not in escritores:
+                    temporales[ruta] = temporal_particion(ruta)
+                    escritores[ruta] = pq.ParquetWriter(temporales[ruta], tabla.schema)
+                    esquema = tabla.schema
+                escritores[ruta].write_table(tabla)
+    except BaseException:
+        for escritor in escritores.values():
+            escritor.close()
+        for temporal in temporales.values():
+            temporal.unlink(missing_ok=True)
+        raise
+    for escritor in escritores.values():
+        escritor.close()
+    for ruta, temporal in temporales.items():
+        temporal.replace(ruta)
+
+    for clave in claves:
+        ruta = ruta_particion(*clave.split("|"))
+        if ruta not in escritores and esquema is not None:
+            temporal = temporal_particion(ruta)
+            pq.write_table(esquema.empty_table(), temporal)
+            temporal.replace(ruta)
+
+
+def particion_vigente(anio, region, tipo):
+    """La partición existe y, si es de un año que aún recibe procesos, se
+    escribió hace menos de TTL_ANIO_ACTUAL (la misma caducidad que sus
+    respuestas en la caché)."""
+    try:
+        escrita = ruta_particion(anio, region, tipo).stat().st_mtime
+    except FileNotFoundError:
+        return False
+    ttl = ttl_para_anio(anio)
+    return ttl is None or time.time() - escrita < ttl
+
+
+def almacen_completo(years, region, tipo):
+    return all(particion_vigente(*subconsulta) for subconsulta in planificar_consultas(years, region, tipo))
+
+
+def filtro_almacen(years, region, tipo):
+    return [("anio", "in", list(years)), ("provincia", "==", region), ("consulta", "==", tipo)]
+
+
+def cargar_desde_almacen(years, region, tipo, columnas=None):
+    # Los filtros sobre las claves de partición solo abren los archivos necesarios
+    df = pd.read_parquet(ALMACEN_DIR, engine="pyarrow", columns=columnas, filters=filtro_almacen(years, region, tipo))
+    if "consulta" in df.columns:
+        df = df.drop(columns="consulta")
+    if "provincia" in df.columns:
+        df["provincia"] = df["provincia"].astype("string")
+    if "anio" in df.columns:
+        df = df.rename(columns={"anio": "anio_consulta"})
+    return df.drop_duplicates(subset=["ocid"], keep="first")
+
+
+def aplicar_esquema(df):
+    """Deja solo las columnas del esquema y las convierte a sus tipos compactos."""
+    df = df[[columna for columna in ESQUEMA if columna in df.columns]]
+    return df.astype({columna: ESQUEMA[columna] for columna in df.columns})
+
+
+def memoria_mb(df):
+    return df.memory_usage(deep=True).sum() / 1024 / 1024
+
+
+def iterar_almacen(years, region, tipo, columnas, tamano=LOTE_REGISTROS * 20):
+    dataset = ds.dataset(ALMACEN_DIR, format="parquet", partitioning="hive")
+    filtro = pq.filters_to_expression(filtro_almacen(years, region, tipo))
+    for batch in dataset.to_batches(columns=columnas, filter=filtro, batch_size=tamano):
+        yield batch.to_pandas()
+
+
+class TopK:
+    """Resumen Space-Saving de frecuencias con como mucho `capacidad`
+    contadores. Cada lote (conteos exactos) se mezcla con el resumen: un
+    valor que no está en un resumen lleno pudo aparecer antes hasta el
+    mínimo de los contadores, así que entra con ese mínimo más su conteo y
+    lo anota como error. `cantidad` es una cota superior de la frecuencia
+    real y `cantidad - error` una cota inferior."""
+
+    def __init__(self, capacidad=CAPACIDAD_TOP_K):
+        self.capacidad = capacidad
+        self.contadores = {}
+        self.errores = {}
+
+    def agregar(self, conteos):
+        minimo = min(self.contadores.values()) if len(self.contadores) >= self.capacidad else 0
+        for valor, cantidad in conteos.items():
+            if valor in self.contadores:
+                self.contadores[valor] += int(cantidad)
+            else:
+                self.contadores[valor] = minimo + int(cantidad)
+                self.errores[valor] = minimo
+        if len(self.contadores) > self.capacidad:
+            self.contadores = dict(heapq.nlargest(self.capacidad, self.contadores.items(), key=lambda item: item[1]))
+            self.errores = {valor: self.errores[valor] for valor in self.contadores}
+
+    def top(self, k, columna):
+        ordenados = heapq.nlargest(k, self.contadores.items(), key=lambda item: item[1])
+        return pd.DataFrame(
+            [(valor, cantidad, self.errores[valor]) for valor, cantidad in ordenados],
+            columns=[columna, "cantidad", "error"],
+        )
+
+
+def construir_rollups(years, region, tipo):
+    """Recorre el almacén por lotes una sola vez y deja listos el cubo
+    año × mes × tipo × provincia (cantidad, monto y contratos), los top-k de
+    entidades y proveedores y los conteos de valores únicos."""
+    columnas = ["ocid", "year", "month", "tipo_contratacion", "provincia", "entidad_compradora", "proveedor",
+                "monto_total", "num_contratos"]
+    parciales = []
+    top_entidades = TopK()
+    top_proveedores = TopK()
+    entidades = set()
+    proveedores = set()
+    vistos = set()
+    for lote in iterar_almacen(years, region, tipo, columnas):
+        lote = aplicar_esquema(descartar_vistos(lote, vistos))
+        parciales.append(
+            lote.groupby(DIMENSIONES_CUBO, dropna=False, observed=True)
+            .agg(cantidad=("ocid", "size"), monto_total=("monto_total", "sum"), num_contratos=("num_contratos", "sum"))
+            .reset_index()
+        )
+        top_entidades.agregar(lote["entidad_compradora"].value_counts().loc[lambda conteos: conteos > 0])
+        top_proveedores.agregar(lote["proveedor"].value_counts().loc[lambda conteos: conteos > 0])
+        entidades.update(lote["entidad_compradora"].dropna())
+        proveedores.update(lote["proveedor"].dropna())
+
+    if parciales:
+        cubo = (
+            pd.concat(parciales, ignore_index=True)
+            .groupby(DIMENSIONES_CUBO, dropna=False, observed=True)[MEDIDAS_CUBO]
+            .sum()
+            .reset_index()
+        )
+    else:
+        cubo = pd.DataFrame(columns=DIMENSIONES_CUBO + MEDIDAS_CUBO)
+
+    return {
+        "cubo": cubo,
+        "top_entidades": top_entidades,
+        "top_proveedores": top_proveedores,
+        "entidades_unicas": len(entidades),
+        "proveedores_unicos": len(proveedores),
+    }
+
+
+def limitar_categorias(df, columna, medida="cantidad", n=MAX_CATEGORIAS_GRAFICO, otros="Otros"):
+    """Deja las `n` categorías de `columna` con mayor `medida` en un agregado
+    del cubo y suma el resto en `otros`, para acotar las trazas y el tamaño
+    de la figura que se envía al navegador."""
+    totales = df.groupby(columna, observed=True)[medida].sum()
+    if len(totales) <= n:
+        return df
+    principales = totales.nlargest(n - 1).index
+    df = df.assign(**{columna: df[columna].astype("string").where(df[columna].isin(principales), otros)})
+    claves = [c for c in df.columns if c not in MEDIDAS_CUBO]
+    medidas = [c for c in df.columns if c in MEDIDAS_CUBO]
+    return df.groupby(claves, dropna=False, sort=False)[medidas].sum().reset_index()
+
+
+def consulta_fts(texto):
+    # Cada palabra como prefijo entre comillas: sin sintaxis FTS5 del usuario y todas obligatorias
+    return " ".join(f'"{palabra}"*' for palabra in re.findall(r"\w+", texto))
+
+
+class IndiceBusqueda:
+    """Índice local sobre el almacén para explorar los procesos ya
+    descargados sin volver a la API: una tabla SQLite con índices para
+    filtrar por faceta y por rangos de monto y fecha, y una tabla FTS5
+    (sin distinguir tildes) sobre entidad, proveedor, título, descripción y
+    tipo. Cada partición del almacén se reindexa solo cuando su archivo
+    cambia; un ocid presente en varias particiones se indexa una vez y sus
+    provincias (las de las particiones provinciales que lo contienen, no
+    "TODAS") se guardan aparte, así que puede tener varias o ninguna.
+
+    Los filtros son un dict con `texto`, listas de valores por faceta
+    (`tipo_contratacion`, `provincia`, `anio`, `entidad_compradora`,
+    `proveedor`), `monto_min`/`monto_max` y `fecha_desde`/`fecha_hasta`
+    (texto "AAAA-MM-DD")."""
+
+    FACETAS = ["tipo_contratacion", "provincia", "anio", "entidad_compradora", "proveedor"]
+    COLUMNAS = ["ocid", "fecha", "anio", "tipo_contratacion", "entidad_compradora", "proveedor",
+                "monto_total", "num_contratos", "title", "description", "particion"]
+    # Se incrementa al cambiar el esquema: el índice se deriva del almacén y se reconstruye entero
+    VERSION = 2
+
+    def __init__(self, ruta):
+        ruta = Path(ruta)
+        ruta.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(ruta, timeout=30, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            if self.conn.execute("PRAGMA user_version").fetchone()[0] != self.VERSION:
+                self.conn.executescript(
+                    """DROP TABLE IF EXISTS procesos_fts;
+                    DROP TABLE IF EXISTS procesos;
+                    DROP TABLE IF EXISTS procesos_provincias;
+                    DROP TABLE IF EXISTS particiones;"""
+                )
+                self.conn.execute(f"PRAGMA user_version = {self.VERSION}")
+            self.conn.executescript(
+                """CREATE TABLE IF NOT EXISTS procesos (
+                    ocid TEXT PRIMARY KEY,
+                    fecha TEXT,
+                    anio INTEGER,
+                    tipo_contratacion TEXT,
+                    entidad_compradora TEXT,
+                    proveedor TEXT,
+                    monto_total REAL,
+                    num_contratos INTEGER,
+                    title TEXT,
+                    description TEXT,
+                    particion TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_procesos_particion ON procesos (particion);
+                CREATE INDEX IF NOT EXISTS idx_procesos_tipo ON procesos (tipo_contratacion);
+                CREATE INDEX IF NOT EXISTS idx_procesos_anio ON procesos (anio);
+                CREATE INDEX IF NOT EXISTS idx_procesos_entidad ON procesos (entidad_compradora);
+                CREATE INDEX IF NOT EXISTS idx_procesos_proveedor ON procesos (proveedor);
+                CREATE INDEX IF NOT EXISTS idx_procesos_fecha ON procesos (fecha);
+                CREATE INDEX IF NOT EXISTS idx_procesos_monto ON procesos (monto_total);
+                CREATE VIRTUAL TABLE IF NOT EXISTS procesos_fts USING fts5(
+                    entidad_compradora, proveedor, title, description, tipo_contratacion,
+                    content='procesos', tokenize='unicode61 remove_diacritics 2'
+                );
+                CREATE TABLE IF NOT EXISTS procesos_provincias (
+                    ocid TEXT NOT NULL,
+                    provincia TEXT NOT NULL,
+                    particion TEXT NOT NULL,
+                    PRIMARY KEY (particion, ocid)
+                );
+                CREATE INDEX IF NOT EXISTS idx_procesos_provincias_ocid ON procesos_provincias (ocid);
+                CREATE INDEX IF NOT EXISTS idx_procesos_provincias_provincia ON procesos_provincias (provincia, ocid);
+                CREATE TABLE IF NOT EXISTS particiones (
+                    ruta TEXT PRIMARY KEY,
+                    mtime_ns INTEGER NOT NULL,
+                    filas INTEGER NOT NULL
+                );"""
+            )
+
+    def sincronizar(self, progreso=None):
+        """Indexa las particiones nuevas o reescritas del almacén y quita las
+        que ya no existen. Devuelve cuántas particiones se actualizaron."""
+        actuales = {
+            ruta.relative_to(ALMACEN_DIR).as_posix(): ruta.stat().st_mtime_ns
+            for ruta in ALMACEN_DIR.glob("anio=*/provincia=*/consulta=*/part-0.parquet")
+        }
+        with self.lock:
+            indexadas = dict(self.conn.execute("SELECT ruta, mtime_ns FROM particiones"))
+        pendientes = [ruta for ruta in indexadas if ruta not in actuales]
+        pendientes += [ruta for ruta, mtime in actuales.items() if indexadas.get(ruta) != mtime]
+        # El texto completo se sincroniza por partición con un INSERT ... SELECT: fila a fila (con triggers) es ~4x más lento
+        texto = "entidad_compradora, proveedor, title, description, tipo_contratacion"
+        for idx, particion in enumerate(pendientes):
+            with self.lock, self.conn:
+                self.conn.execute(
+                    f"INSERT INTO procesos_fts (procesos_fts, rowid, {texto}) "
+                    f"SELECT 'delete', rowid, {texto} FROM procesos WHERE particion = ?",
+                    (particion,),
+                )
+                self.conn.execute("DELETE FROM procesos WHERE particion = ?", (particion,))
+                self.conn.execute("DELETE FROM procesos_provincias WHERE particion = ?", (particion,))
+                self.conn.execute("DELETE FROM particiones WHERE ruta = ?", (particion,))
+                if particion in actuales:
+                    filas = self._indexar(particion)
+                    self.conn.execute(
+                        f"INSERT INTO procesos_fts (rowid, {texto}) SELECT rowid, {texto} FROM procesos WHERE particion = ?",
+                        (particion,),
+                    )
+                    self.conn.execute("INSERT INTO particiones VALUES (?, ?, ?)", (particion, actuales[particion], filas))
+            if progreso:
+                progreso(idx + 1, len(pendientes))
+        return len(pendientes)
+
+    def _indexar(self, particion):
+        provincia = Path(particion).parts[1].split("=", 1)[1]
+        columnas = ["ocid", "date", "year", "tipo_contratacion", "entidad_compradora", "proveedor",
+                    "monto_total", "num_contratos", "title", "description"]
+        sentencia = f"INSERT OR IGNORE INTO procesos ({', '.join(self.COLUMNAS)}) VALUES ({', '.join('?' * len(self.COLUMNAS))})"
+        # El primer archivo que indexa un ocid se queda con su fila, pero la provincia se anota por partición
+        pertenencia = "INSERT OR IGNORE INTO procesos_provincias (ocid, provincia, particion) VALUES (?, ?, ?)"
+        filas = 0
+        archivo = pq.ParquetFile(ALMACEN_DIR / particion)
+        for lote in archivo.iter_batches(batch_size=LOTE_REGISTROS, columns=columnas):
+            valores = {columna: lote.column(columna).to_pylist() for columna in columnas if columna != "date"}
+            fechas = lote.column("date").cast(pa.timestamp("s"), safe=False)
+            fechas = pc.strftime(fechas, format="%Y-%m-%d %H:%M:%S").to_pylist()
+            self.conn.executemany(sentencia, zip(
+                valores["ocid"], fechas, valores["year"], valores["tipo_contratacion"],
+                valores["entidad_compradora"], valores["proveedor"], valores["monto_total"],
+                valores["num_contratos"], valores["title"], valores["description"], repeat(particion),
+            ))
+            if provincia != "TODAS":
+                self.conn.executemany(pertenencia, zip(valores["ocid"], repeat(provincia), repeat(particion)))
+            filas += lote.num_rows
+        return filas
+
+    def _condiciones(self, filtros, excluir=None):
+        condiciones = []
+        parametros = []
+        texto = consulta_fts(filtros.get("texto") or "")
+        if texto:
+            condiciones.append("rowid IN (SELECT rowid FROM procesos_fts WHERE procesos_fts MATCH ?)")
+            parametros.append(texto)
+        for columna in self.FACETAS:
+            valores = filtros.get(columna)
+            if valores and columna != excluir:
+                marcadores = ", ".join("?" * len(valores))
+                if columna == "provincia":
+                    condiciones.append(f"ocid IN (SELECT ocid FROM procesos_provincias WHERE provincia IN ({marcadores}))")
+                else:
+                    condiciones.append(f"{columna} IN ({marcadores})")
+                parametros.extend(valores)
+        for clave, condicion in (("monto_min", "monto_total >= ?"), ("monto_max", "monto_total <= ?"),
+                                 ("fecha_desde", "fecha >= ?"), ("fecha_hasta", "fecha < date(?, '+1 day')")):
+            if filtros.get(clave) is not None:
+                condiciones.append(condicion)
+                parametros.append(filtros[clave])
+        return (" WHERE " + " AND ".join(condiciones) if condiciones else ""), parametros
+
+    def _consultar(self, sql, parametros=()):
+        with self.lock:
+            return pd.read_sql_query(sql, self.conn, params=parametros)
+
+    def buscar(self, filtros, limite=LIMITE_RESULTADOS):
+        where, parametros = self._condiciones(filtros)
+        return self._consultar(
+            f"""SELECT ocid, fecha, anio,
+                       (SELECT group_concat(DISTINCT provincia) FROM procesos_provincias
+                        WHERE procesos_provincias.ocid = procesos.ocid) AS provincia,
+                       tipo_contratacion, entidad_compradora, proveedor,
+                       monto_total, num_contratos, title, description
+                FROM procesos{where} ORDER BY monto_total DESC LIMIT ?""",
+            [*parametros, limite],
+        )
+
+    def resumen(self, filtros):
+        where, parametros = self._condiciones(filtros)
+        fila = self._consultar(
+            f"SELECT COUNT(*) AS cantidad, COALESCE(SUM(monto_total), 0) AS monto_total FROM procesos{where}", parametros
+        ).iloc[0]
+        return int(fila["cantidad"]), float(fila["monto_total"])
+
+    def facetas(self, columna, filtros, limite=50):
+        """Conteo y monto por valor de una faceta con el resto de filtros
+        aplicados (sin el de la propia faceta, para poder cambiarlo)."""
+        if columna not in self.FACETAS:
+            raise ValueError(f"Faceta desconocida: {columna}")
+        where, parametros = self._condiciones(filtros, excluir=columna)
+        if columna == "provincia":
+            return self._consultar(
+                f"""SELECT provincia, COUNT(*) AS cantidad, COALESCE(SUM(monto_total), 0) AS monto_total
+                    FROM (SELECT DISTINCT ocid, provincia FROM procesos_provincias)
+                    JOIN (SELECT ocid, monto_total FROM procesos{where}) USING (ocid)
+                    GROUP BY provincia ORDER BY cantidad DESC LIMIT ?""",
+                [*parametros, limite],
+            )
+        return self._consultar(
+            f"""SELECT {columna}, COUNT(*) AS cantidad, COALESCE(SUM(monto_total), 0) AS monto_total
+                FROM procesos{where}{" AND" if where else " WHERE"} {columna} IS NOT NULL
+                GROUP BY {columna} ORDER BY cantidad DESC LIMIT ?""",
+            [*parametros, limite],
+        )
+
+    def total(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM procesos").fetchone()[0]
+
+
+def directorio_trabajo(years, region, tipo):
+    return LOTES_DIR / f"{'-'.join(map(str, years))}_{region}_{tipo}"
+
+
+class TrabajoDescarga:
+    """Descarga completa de una consulta (páginas, montos y escritura en el
+    almacén) ejecutada en un hilo aparte. Tras cada página, cada lote de
+    LOTE_MONTOS montos y al detenerse deja un punto de control en su
+    directorio de lotes, así que si se interrumpe (recarga del navegador,
+    reinicio del servidor o un error) la siguiente ejecución con la misma
+    consulta continúa donde quedó, repitiendo como mucho un lote de montos. La interfaz solo
+    lee `estado`, `etapa`, `progreso`, `detalle`, `mensajes` y `metricas`."""
+
+    def __init__(self, years, region, tipo, opciones, cache=None, estado_sync=None):
+        self.years = list(years)
+        self.region = region
+        self.tipo = tipo
+        self.opciones = {"subconsultas_paralelas": MAX_SUBCONSULTAS, **opciones}
+        self.cache = cache if opciones["usar_cache"] else None
+        self.estado_sync = estado_sync
+        self.estado = "pendiente"
+        self.etapa = ""
+        self.detalle = ""
+        self.progreso = 0.0
+        self.mensajes = []
+        self.metricas = Metricas()
+        self.detener = threading.Event()
+        self.hilo = None
+
+    @property
+    def consulta(self):
+        return (tuple(self.years), self.region, self.tipo)
+
+    def iniciar(self):
+        self.estado = "en curso"
+        self.hilo = threading.Thread(target=self.ejecutar, name=f"descarga-{self.consulta}", daemon=True)
+        self.hilo.start()
+
+    def cancelar(self):
+        self.detener.set()
+
+    def activo(self):
+        return self.hilo is not None and self.hilo.is_alive()
+
+    def registrar(self, nivel, texto):
+        self.mensajes.append((nivel, texto))
+
+    def ejecutar(self):
+        lotes = None
+        cliente = None
+        self.estado = "en curso"
+        try:
+            lotes = DirectorioLotes(
+                directorio_trabajo(self.years, self.region, self.tipo), reanudar=True, metricas=self.metricas
+            )
+            if lotes.checkpoint["archivos"]:
+                self.registrar("info", f"⏯️ Reanudando la descarga anterior ({lotes.filas} registros ya guardados)")
+            lotes.checkpoint["parametros"] = {
+                "years": self.years, "region": self.region, "tipo": self.tipo, "opciones": self.opciones
+            }
+            lotes.guardar_checkpoint()
+            cliente = ClienteHTTP(
+                LimitadorTasa(self.opciones["peticiones_por_segundo"]),
+                self.opciones["max_workers"] * self.opciones["subconsultas_paralelas"],
+                metricas=self.metricas,
+            )
+
+            with self.metricas.etapa("descarga_paginas") as etapa:
+                filas_previas = lotes.filas
+                self._descargar_paginas(lotes, cliente)
+                etapa["filas"] = lotes.filas - filas_previas
+            if self.detener.is_set():
+                self.estado = "cancelado"
+                return
+            subconsultas = [clave_subconsulta(*subconsulta) for subconsulta in planificar_consultas(self.years, self.region, self.tipo)]
+            if lotes.filas == 0 and set(subconsultas) <= set(lotes.checkpoint["completas"]):
+                self.registrar("error", "❌ No se encontraron datos con los filtros aplicados")
+                self.estado = "error"
+                lotes.eliminar()
+                return
+
+            if lotes.filas:
+                self._consultar_montos(lotes, cliente)
+            if self.detener.is_set():
+                self.estado = "cancelado"
+                return
+
+            red = cliente.estadisticas()
+            if red["peticiones"]:
+                self.registrar(
+                    "caption",
+                    f"🌐 {red['peticiones']} peticiones HTTP | {red['bytes'] / 1024 / 1024:,.1f} MB descargados | "
+                    f"latencia media {red['latencia_media'] * 1000:,.0f} ms (p95 {red['latencia_p95'] * 1000:,.0f} ms) | "
+                    f"{red['reintentos']} reintentos"
+                )
+
+            # Una subconsulta con páginas o montos fallidos no se publica: el punto de control se conserva para reanudarla
+            incompletas = set(subconsultas).difference(lotes.checkpoint["completas"]) | lotes.claves_sin_montos()
+            self.etapa = "💾 Guardando en el almacén local"
+            with self.metricas.etapa("escritura_almacen", lotes.filas):
+                escribir_almacen(lotes, lotes.montos(), [clave for clave in subconsultas if clave not in incompletas])
+            if incompletas:
+                self.registrar(
+                    "warning",
+                    f"⚠️ {len(incompletas)} de {len(subconsultas)} subconsultas quedaron incompletas por páginas o montos "
+                    "fallidos; no se guardan en el almacén y se reanudarán al volver a cargar los datos"
+                )
+                self.estado = "incompleto"
+                return
+            lotes.eliminar()
+            self.progreso = 1.0
+            self.estado = "completado"
+        except Exception as e:
+            self.registrar("error", f"❌ Error en la descarga: {e}")
+            self.estado = "error"
+        finally:
+            if cliente is not None:
+                cliente.cerrar()
+            if self.estado == "cancelado":
+                self.registrar("warning", "⏹️ Descarga detenida; se reanudará desde este punto al volver a cargar los datos")
+
+    def _descargar_paginas(self, lotes, cliente):
+        subconsultas = [
+            subconsulta for subconsulta in planificar_consultas(self.years, self.region, self.tipo)
+            if clave_subconsulta(*subconsulta) not in lotes.checkpoint["completas"]
+        ]
+        total = len(planificar_consultas(self.years, self.region, self.tipo))
+        self.etapa = f"📥 Descargando {total} subconsultas (una por año)..."
+        terminadas = total - len(subconsultas)
+        with ThreadPoolExecutor(max_workers=self.opciones["subconsultas_paralelas"]) as executor:
+            futuros = [
+                executor.submit(self._descargar_subconsulta, lotes, cliente, *subconsulta)
+                for subconsulta in subconsultas
+            ]
+            for futuro in as_completed(futuros):
+                futuro.result()
+                terminadas += 1
+                self.progreso = 0.5 * terminadas / total
+            if self.detener.is_set():
+                executor.shutdown(wait=True, cancel_futures=True)
+
+        for current_year in self.years:
+            registros_anio = sum(
+                registros for clave, registros in lotes.checkpoint["registros"].items()
+                if clave.startswith(f"{current_year}|")
+            )
+            self.registrar("success", f"✅ Año {current_year}: {registros_anio} registros obtenidos")
+
+    def _descargar_subconsulta(self, lotes, cliente, current_year, provincia, tipo):
+        if self.detener.is_set():
+            return
+        search_term = tipo if tipo != "TODAS" else "proceso"
+        clave = clave_subconsulta(current_year, provincia, tipo)
+        etiqueta = f"Año {current_year}" + (f" · {provincia}" if provincia != "TODAS" else "") + f" · {tipo}"
+        with lotes.lock:
+            registros = lotes.checkpoint["registros"].get(clave, 0)
+            fallidas = set(lotes.checkpoint["fallidas"].get(clave, []))
+            desde = lotes.checkpoint["paginas"].get(clave, 0) + 1
+
+        def avanzar(page, total_pages, registros):
+            self.detalle = f"📊 {etiqueta} - Página {page} de {total_pages} | Registros: {registros}"
+
+        try:
+            if self.opciones["sync_incremental"]:
+                errores, nuevos = sincronizar_anio(
+                    current_year, search_term, provincia, tipo, cliente, self.estado_sync,
+                    self.opciones["max_workers"], avanzar
+                )
+                for page, e in errores:
+                    self.registrar("error", f"❌ Error de conexión en {etiqueta}, página {page}: {e}")
+                # La marca de agua no avanzó: se vuelve a sincronizar al reanudar
+                fallidas = {page for page, _ in errores}
+                if nuevos:
+                    self.registrar("info", f"🔄 {etiqueta}: {nuevos} registros nuevos o actualizados desde la última sincronización")
+                for lote in self.estado_sync.iterar_registros(current_year, provincia, tipo):
+                    registros += lotes.agregar(normalizar_lote(lote, current_year, provincia, tipo, self.metricas), clave)
+                # Solo los registros nuevos o modificados vuelven a consultar su /record
+                conocidos = self.estado_sync.montos(current_year, provincia, tipo)
+                lotes.guardar_montos(conocidos["ocid"].tolist(), conocidos.dropna(subset=["monto_total"]))
+            else:
+                paginas = iterar_paginas(
+                    current_year, search_term, provincia, cliente, self.opciones["max_workers"], self.cache,
+                    desde=desde, reintentar=fallidas
+                )
+                for page, total_pages, datos, error in paginas:
+                    if self.detener.is_set():
+                        paginas.close()
+                        return
+                    if error is not None:
+                        fallidas.add(page)
+                        self.registrar("error", f"❌ Error de conexión en {etiqueta}, página {page}: {error}")
+                    else:
+                        fallidas.discard(page)
+                        registros += lotes.agregar(normalizar_lote(datos, current_year, provincia, tipo, self.metricas), clave)
+                    with lotes.lock:
+                        if page not in fallidas:
+                            lotes.checkpoint["paginas"][clave] = max(page, lotes.checkpoint["paginas"].get(clave, 0))
+                        lotes.checkpoint["fallidas"][clave] = sorted(fallidas)
+                        lotes.checkpoint["registros"][clave] = registros
+                        lotes.guardar_checkpoint()
+                    avanzar(page, total_pages, registros)
+        except requests.exceptions.RequestException as e:
+            self.registrar("error", f"❌ Error de conexión en {etiqueta}, página 1: {e}")
+            return
+        except Exception as e:
+            self.registrar("error", f"❌ Error al procesar datos de {etiqueta}: {e}")
+            return
+
+        with lotes.lock:
+            lotes.checkpoint["registros"][clave] = registros
+            if not fallidas:
+                lotes.checkpoint["completas"].append(clave)
+            lotes.guardar_checkpoint()
+
+    def _consultar_montos(self, lotes, cliente):
+        self.etapa = "🔍 Obteniendo montos de contratos..."
+        consultados = lotes.ocids_consultados()
+        df_ocids = lotes.ocids_unicos()
+        df_ocids = df_ocids[~df_ocids["ocid"].isin(consultados)]
+        anio_por_ocid = dict(zip(df_ocids["ocid"], df_ocids["anio_consulta"]))
+        ocids = df_ocids["ocid"].tolist()
+        del df_ocids
+
+        def avanzar(hechos, total):
+            self.detalle = f"Consultando monto {hechos} de {total}..."
+            self.progreso = 0.5 + 0.45 * hechos / total
+
+        def guardar(ocids_lote, df_lote):
+            lotes.guardar_montos(ocids_lote, df_lote)
+            if self.opciones["sync_incremental"]:
+                self.estado_sync.guardar_montos(ocids_lote, df_lote)
+
+        aciertos_previos, fallos_previos = (self.cache.aciertos, self.cache.fallos) if self.cache else (0, 0)
+        with self.metricas.etapa("consulta_montos", len(ocids)):
+            _, fallidos = enriquecer_montos(
+                ocids, cliente, self.opciones["max_workers"], avanzar, self.cache, anio_por_ocid,
+                al_obtener=guardar, detener=self.detener
+            )
+        if self.cache:
+            consultas_cache = (self.cache.aciertos - aciertos_previos) + (self.cache.fallos - fallos_previos)
+            if consultas_cache:
+                self.registrar("caption", f"♻️ Caché local: {self.cache.aciertos - aciertos_previos} de {consultas_cache} respuestas reutilizadas")
+
+        con_monto = len(lotes.montos())
+        if con_monto:
+            self.registrar("success", f"✅ Montos obtenidos para {con_monto} registros")
+            if fallidos:
+                self.registrar("warning", f"⚠️ No se pudo consultar el monto de {fallidos} registros tras {MAX_REINTENTOS} reintentos")
+        else:
+            self.registrar("warning", "⚠️ No se pudieron obtener montos para estos registros")
+
+
+def descargas_interrumpidas():
+    # Directorios de lotes con punto de control: descargas que no llegaron al almacén
+    pendientes = []
+    for ruta in sorted(LOTES_DIR.glob("*/checkpoint.json")):
+        parametros = json.loads(ruta.read_text(encoding="utf-8")).get("parametros")
+        if parametros:
+            pendientes.append(parametros)
+    return pendientes
+
+
+def version_almacen(years, region, tipo):
+    # Cambia cada vez que se reescribe alguna partición, invalidando los cachés de Streamlit
+    return tuple(
+        ruta.stat().st_mtime_ns if ruta.exists() else 0
+        for ruta in (ruta_particion(*subconsulta) for subconsulta in planificar_consultas(years, region, tipo))
+    )
+
+
+def nombre_archivo(years, region, tipo):
+    if len(years) > 1:
+        filename = f"compras_publicas_{years[0]}-{years[-1]}"
+    else:
+        filename = f"compras_publicas_{years[0]}"
+
+    if tipo != "TODAS":
+        filename += f"_{tipo.replace(' ', '_')}"
+    if region != "TODAS":
+        filename += f"_{region.replace(' ', '_')}"
+    return filename
+
+
+def escribir_por_lotes(lotes, ruta, formato="csv"):
+    """Escribe una secuencia de DataFrames en un solo archivo (CSV, CSV con
+    gzip o Parquet) sin juntarlos en memoria. Devuelve las filas escritas."""
+    filas = 0
+    if formato == "parquet":
+        escritor = None
+        try:
+            for lote in lotes:
+                tabla = pa.Table.from_pandas(lote, preserve_index=False)
+                if escritor is None:
+                    escritor = pq.ParquetWriter(ruta, tabla.schema)
+                escritor.write_table(tabla)
+                filas += len(lote)
+        finally:
+            if escritor is not None:
+                escritor.close()
+        return filas
+
+    abrir = gzip.open if formato == "csv.gz" else open
+    with abrir(ruta, "wt", encoding="utf-8", newline="") as archivo:
+        for lote in lotes:
+            lote.to_csv(archivo, header=filas == 0, index=False)
+            filas += len(lote)
+    return filas
+
+
+def iterar_exportacion(years, region, tipo):
+    # Filas del almacén por lotes, sin repetir ocid entre subconsultas
+    vistos = set()
+    for lote in iterar_almacen(years, region, tipo, None):
+        lote = descartar_vistos(lote, vistos)
+        if lote.empty:
+            continue
+        yield lote.drop(columns="consulta").rename(columns={"anio": "anio_consulta"})
+
+
+def exportar_dataset(years, region, tipo, ruta, formato="csv", resumen=False):
+    """Escribe el dataset de la consulta desde el almacén, lote a lote, sin
+    cargarlo completo en memoria; con `resumen=True` escribe en su lugar el
+    cubo agregado año × mes × tipo × provincia. Devuelve las filas escritas."""
+    if resumen:
+        lotes = [construir_rollups(years, region, tipo)["cubo"]]
+    else:
+        lotes = iterar_exportacion(years, region, tipo)
+    return escribir_por_lotes(lotes, Path(ruta), formato)
+
+
+def preparar_exportacion(years, region, tipo, formato="csv", resumen=False):
+    """Genera la exportación en EXPORTACIONES_DIR (en un temporal que se
+    renombra al terminar) y devuelve su ruta. Si ya hay una exportación
+    posterior a la última escritura del almacén, se reutiliza."""
+    EXPORTACIONES_DIR.mkdir(parents=True, exist_ok=True)
+    nombre = nombre_archivo(years, region, tipo) + ("_resumen" if resumen else "")
+    ruta = EXPORTACIONES_DIR / f"{nombre}.{formato}"
+    if ruta.exists() and ruta.stat().st_mtime_ns > max(version_almacen(years, region, tipo), default=0):
+        return ruta
+    descriptor, temporal = tempfile.mkstemp(dir=EXPORTACIONES_DIR, prefix=f".{nombre}.", suffix=".tmp")
+    os.close(descriptor)
+    try:
+        exportar_dataset(years, region, tipo, temporal, formato, resumen)
+        Path(temporal).replace(ruta)
+    finally:
+        Path(temporal).unlink(missing_ok=True)
+    return ruta
+
+
+def _descargar_anio_cli(anio, region, tipo, opciones):
+    # Se ejecuta en un proceso aparte por año: abre su propia caché y estado de sincronización
+    cache = CacheRespuestas(CACHE_DIR / "respuestas.sqlite") if opciones["usar_cache"] else None
+    estado_sync = EstadoSync(CACHE_DIR / "sync.sqlite")
+    trabajo = TrabajoDescarga([anio], region, tipo, opciones, cache, estado_sync)
+    trabajo.ejecutar()
+    return anio, trabajo.estado, trabajo.mensajes, trabajo.metricas.a_dict()
+
+
+def parsear_years(texto):
+    years = set()
+    for parte in texto.split(","):
+        if "-" in parte:
+            inicio, fin = parte.split("-")
+            years.update(range(int(inicio), int(fin) + 1))
+        else:
+            years.add(int(parte))
+    return sorted(years)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Descarga procesos de compras públicas de Ecuador al almacén local y los exporta."
+    )
+    parser.add_argument("--years", required=True, help="Años a descargar, p. ej. 2024, 2015-2025 o 2019,2021")
+    parser.add_argument("--region", default="TODAS", choices=["TODAS"] + PROVINCIAS, help="Provincia (por defecto TODAS)")
+    parser.add_argument("--tipo", default="TODAS", choices=["TODAS"] + TIPOS_CONTRATACION, help="Tipo de contratación (por defecto TODAS)")
+    parser.add_argument("--out", type=Path, help="Directorio donde escribir los archivos exportados")
+    parser.add_argument("--formato", nargs="+", choices=list(FORMATOS_EXPORTACION), default=["parquet", "csv"])
+    parser.add_argument("--resumen", action="store_true", help="Exportar el resumen agregado en lugar de los registros")
+    parser.add_argument("--procesos", type=int, default=min(4, os.cpu_count() or 1), help="Años descargados en paralelo")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS_PAGINAS, help="Descargas simultáneas por subconsulta")
+    parser.add_argument("--subconsultas", type=int, default=MAX_SUBCONSULTAS, help="Subconsultas en paralelo por proceso")
+    parser.add_argument("--peticiones-por-segundo", type=float, default=PETICIONES_POR_SEGUNDO,
+                        help="Límite total de peticiones a la API, repartido entre los procesos")
+    parser.add_argument("--sin-cache", action="store_true", help="No reutilizar respuestas de la caché local")
+    parser.add_argument("--incremental", action="store_true", help="Sincronización incremental")
+    parser.add_argument("--forzar", action="store_true",
+                        help="Descargar aunque el almacén ya tenga la consulta (el año en curso se refresca al caducar)")
+    parser.add_argument("--metricas", type=Path,
+                        help="Archivo donde guardar las métricas de la descarga (.prom para Prometheus, si no JSON)")
+    args = parser.parse_args(argv)
+
+    years = parsear_years(args.years)
+    procesos = max(1, min(args.procesos, len(years)))
+    opciones = {
+        "max_workers": args.workers,
+        "subconsultas_paralelas": args.subconsultas,
+        "peticiones_por_segundo": args.peticiones_por_segundo / procesos,
+        "usar_cache": not args.sin_cache,
+        "sync_incremental": args.incremental,
+    }
+
+    pendientes = [anio for anio in years if args.forzar or not almacen_completo([anio], args.region, args.tipo)]
+    if pendientes:
+        print(f"Descargando {len(pendientes)} años con {procesos} procesos...", flush=True)
+        fallidos = []
+        metricas = Metricas()
+        with ProcessPoolExecutor(max_workers=procesos) as executor:
+            futuros = [executor.submit(_descargar_anio_cli, anio, args.region, args.tipo, opciones) for anio in pendientes]
+            for futuro in as_completed(futuros):
+                anio, estado, mensajes, metricas_anio = futuro.result()
+                metricas.agregar(metricas_anio)
+                for nivel, texto in mensajes:
+                    print(texto, file=sys.stderr if nivel in ("error", "warning") else sys.stdout, flush=True)
+                if estado != "completado":
+                    fallidos.append(anio)
+        if args.metricas:
+            args.metricas.write_text(
+                metricas.exportar_prometheus() if args.metricas.suffix == ".prom" else metricas.exportar_json(),
+                encoding="utf-8",
+            )
+        if fallidos:
+            print(f"No se completaron los años: {', '.join(map(str, sorted(fallidos)))}", file=sys.stderr)
+            return 1
+    else:
+        print("El almacén local ya contiene la consulta completa; no hay nada que descargar.")
+
+    if args.out:
+        args.out.mkdir(parents=True, exist_ok=True)
+        base = nombre_archivo(years, args.region, args.tipo) + ("_resumen" if args.resumen else "")
+        for formato in args.formato:
+            ruta = args.out / f"{base}.{formato}"
+            filas = exportar_dataset(years, args.region, args.tipo, ruta, formato, args.resumen)
+            print(f"{ruta}: {filas} filas")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,183 @@
-import requests
-import pandas as pd
 import plotly.express as px
 import streamlit as st
+import threading
 import time
 
+from compras_publicas import (
+    CACHE_DIR,
+    CACHE_MAX_BYTES,
+    COLUMNAS_DASHBOARD,
+    FORMATOS_EXPORTACION,
+    INDICE_BUSQUEDA,
+    LIMITE_RESULTADOS,
+    LOTE_MONTOS,
+    MAX_SUBCONSULTAS,
+    MAX_WORKERS_PAGINAS,
+    PETICIONES_POR_SEGUNDO,
+    PROVINCIAS,
+    TIPOS_CONTRATACION,
+    CacheRespuestas,
+    EstadoSync,
+    IndiceBusqueda,
+    Metricas,
+    TrabajoDescarga,
+    almacen_completo,
+    aplicar_esquema,
+    cargar_desde_almacen,
+    construir_rollups,
+    descargas_interrumpidas,
+    limitar_categorias,
+    memoria_mb,
+    nombre_archivo,
+    preparar_exportacion,
+    version_almacen,
+)
+
+
+@st.cache_data(show_spinner="Cargando datos del almacén local...", max_entries=8)
+def resumir_dataset(years, region, tipo, version):
+    # Solo se cachea lo que muestra la página: st.cache_data copiaría el dataset completo en cada recarga
+    df = cargar_desde_almacen(years, region, tipo, COLUMNAS_DASHBOARD)
+    memoria_antes = memoria_mb(df)
+    df = aplicar_esquema(df)
+    return {
+        "vista": df.head(10),
+        "filas": df.shape[0],
+        "columnas": list(df.columns),
+        "memoria_antes": memoria_antes,
+        "memoria_despues": memoria_mb(df),
+    }
+
+
+@st.cache_data(show_spinner="Calculando agregados...", max_entries=8)
+def calcular_rollups(years, region, tipo, version):
+    return construir_rollups(years, region, tipo)
+
+
+@st.cache_resource
+def obtener_cache():
+    return CacheRespuestas(CACHE_DIR / "respuestas.sqlite")
+
+
+@st.cache_resource
+def obtener_estado_sync():
+    return EstadoSync(CACHE_DIR / "sync.sqlite")
+
+
+@st.cache_resource
+def obtener_indice():
+    return IndiceBusqueda(INDICE_BUSQUEDA)
+
+
+@st.cache_resource
+def obtener_trabajos():
+    # Compartido por todas las sesiones: una recarga del navegador no pierde la descarga en curso
+    return {}
+
+
+@st.cache_resource
+def bloqueo_trabajos():
+    # Cada sesión corre en su propio hilo: sin el bloqueo, dos clics simultáneos lanzarían dos descargas de la misma consulta
+    return threading.Lock()
+
+
+def lanzar_trabajo(years, region, tipo, opciones):
+    trabajos = obtener_trabajos()
+    consulta = (tuple(years), region, tipo)
+    with bloqueo_trabajos():
+        trabajo = trabajos.get(consulta)
+        if trabajo is None or not trabajo.activo():
+            trabajo = TrabajoDescarga(years, region, tipo, opciones, obtener_cache(), obtener_estado_sync())
+            trabajos[consulta] = trabajo
+            trabajo.iniciar()
+    st.session_state["trabajo"] = consulta
+
+
+# Sondeo del progreso: mientras la descarga sigue solo se vuelve a ejecutar este
+# fragmento cada segundo; al terminar, la página completa muestra el resultado
+@st.fragment(run_every=1)
+def progreso_descarga(trabajo):
+    if not trabajo.activo():
+        st.rerun()
+    st.subheader("⏳ Descarga en segundo plano")
+    if len(trabajo.years) > 1:
+        st.warning(f"⚠️ Analizando {len(trabajo.years)} años. Este proceso puede tardar bastante tiempo (varios minutos).")
+    else:
+        st.info("Cargando datos desde la API oficial... esto puede tardar varios minutos")
+    st.progress(min(trabajo.progreso, 1.0), text=trabajo.etapa)
+    st.caption(trabajo.detalle)
+    st.caption(
+        "La descarga continúa aunque se recargue la página; el progreso se guarda tras cada página "
+        f"y cada lote de {LOTE_MONTOS} montos, y también al detenerla."
+    )
+    if st.button("⏹️ Detener descarga"):
+        trabajo.cancelar()
+
+
+def mostrar_grafico(fig, nombre, metricas):
+    with metricas.etapa("render_grafico", figura=nombre):
+        st.plotly_chart(fig, width="stretch")
+
+
+def metricas_fragmento(nombre):
+    # Un fragmento puede volver a ejecutarse solo: mide en su propio Metricas, guardado
+    # en la sesión, y el panel de rendimiento suma la última ejecución de cada uno
+    metricas = Metricas()
+    st.session_state.setdefault("metricas_fragmentos", {})[nombre] = metricas
+    return metricas
+
+
+# Gráficos secundarios: se construyen solo al activarlos y el interruptor
+# vuelve a ejecutar únicamente su fragmento, no toda la página
+@st.fragment
+def grafico_mes_tipo(cubo):
+    metricas = metricas_fragmento("mes_tipo")
+    if not st.toggle("e) Ver procesos por mes y tipo de contratación", key="ver-mes-tipo"):
+        return
+    tipo_mes = limitar_categorias(
+        cubo.groupby(["month", "tipo_contratacion"], observed=True)["cantidad"].sum().reset_index(),
+        "tipo_contratacion"
+    )
+    fig5 = px.bar(tipo_mes, x="month", y="cantidad", 
+                  color="tipo_contratacion",
+                  title="e) Procesos por Mes y Tipo de Contratación",
+                  barmode="stack",
+                  labels={"cantidad": "Cantidad de Procesos", "month": "Mes", "tipo_contratacion": "Tipo"})
+    mostrar_grafico(fig5, "mes_tipo", metricas)
+    st.caption("👉 Distribución mensual detallada por tipo de contratación.")
+
+
+@st.fragment
+def comparativas_anuales(cubo, monto_total):
+    metricas = metricas_fragmento("comparativas_anuales")
+    if not st.toggle("g/h) Ver comparativas de tipos de contratación por año", key="ver-comparativas"):
+        return
+    tipo_year = limitar_categorias(
+        cubo.groupby(["year", "tipo_contratacion"], observed=True)[["cantidad", "monto_total"]].sum().reset_index(),
+        "tipo_contratacion"
+    )
+
+    fig_comp = px.line(tipo_year, x="year", y="cantidad", 
+                      color="tipo_contratacion",
+                      title="g) Comparativa de Tipos de Contratación por Año",
+                      markers=True,
+                      labels={"cantidad": "Cantidad de Procesos", "year": "Año", "tipo_contratacion": "Tipo"})
+    mostrar_grafico(fig_comp, "comparativa_tipos", metricas)
+    st.caption("👉 Evolución temporal de cada tipo de contratación a lo largo de los años analizados.")
+
+    if monto_total > 0:
+        tipo_year_monto = tipo_year[tipo_year["monto_total"] > 0]
+
+        if not tipo_year_monto.empty:
+            fig_comp_monto = px.line(tipo_year_monto, x="year", y="monto_total", 
+                                    color="tipo_contratacion",
+                                    title="h) Comparativa de Montos por Tipo de Contratación y Año",
+                                    markers=True,
+                                    labels={"monto_total": "Monto Total ($)", "year": "Año", "tipo_contratacion": "Tipo"})
+            mostrar_grafico(fig_comp_monto, "comparativa_montos", metricas)
+            st.caption("👉 Evolución de los montos contratados por tipo a lo largo de los años.")
+
+
 st.set_page_config(
     page_title="Análisis de Compras Públicas Ecuador",
     layout="wide",
@@ -36,32 +210,185 @@ else:
 
 region = st.sidebar.selectbox(
     "Provincia", 
-    ["TODAS", "Pichincha", "Guayas", "Azuay", "Manabí", "El Oro", 
-     "Tungurahua", "Los Ríos", "Imbabura", "Chimborazo", "Cotopaxi",
-     "Loja", "Esmeraldas", "Santo Domingo", "Santa Elena", "Bolívar",
-     "Cañar", "Carchi", "Pastaza", "Morona Santiago", "Napo",
-     "Zamora Chinchipe", "Sucumbíos", "Orellana", "Galápagos"],
+    ["TODAS"] + PROVINCIAS,
     help="Selecciona una provincia específica o TODAS para consultar todo el país"
 )
 
 tipo_contratacion = st.sidebar.selectbox(
     "Tipo de contratación", 
-    ["TODAS", "Bienes", "Obras", "Servicios", "Consultoría", "Licitación", 
-     "Menor Cuantía", "Ínfima Cuantía", "Subasta", "Catálogo"],
+    ["TODAS"] + TIPOS_CONTRATACION,
     help="Selecciona un tipo específico o TODAS para todos los tipos de contratación"
 )
 
+with st.sidebar.expander("🚀 Opciones de descarga"):
+    max_workers = st.number_input("Descargas simultáneas", min_value=1, max_value=16, value=MAX_WORKERS_PAGINAS)
+    subconsultas_paralelas = st.number_input(
+        "Subconsultas en paralelo", min_value=1, max_value=16, value=MAX_SUBCONSULTAS,
+        help="Cada año de la consulta se descarga como una subconsulta independiente"
+    )
+    peticiones_por_segundo = st.number_input(
+        "Peticiones por segundo", min_value=0.5, max_value=20.0, value=PETICIONES_POR_SEGUNDO, step=0.5,
+        help="Límite de peticiones a la API compartido por todas las descargas simultáneas"
+    )
+    usar_cache = st.checkbox(
+        "Usar caché local", value=True,
+        help="Reutiliza las respuestas ya descargadas: los años cerrados no caducan y el año en curso caduca en una hora"
+    )
+    sync_incremental = st.checkbox(
+        "🔄 Sincronización incremental", value=False,
+        help="Recuerda lo ya descargado por año, provincia y tipo, y solo consulta los registros posteriores a la última sincronización"
+    )
+    usar_almacen = st.checkbox(
+        "📦 Leer del almacén local (Parquet)", value=True,
+        help="Si el dataset limpio de estos filtros ya está guardado en disco, se carga de ahí sin consultar la API; "
+             "el año en curso se vuelve a descargar cuando su partición tiene más de una hora"
+    )
+
+with st.sidebar.expander("🗄️ Caché local"):
+    cache = obtener_cache()
+    estadisticas_cache = cache.estadisticas()
+    if estadisticas_cache.empty:
+        st.write("La caché está vacía.")
+    else:
+        st.dataframe(estadisticas_cache, hide_index=True)
+        st.caption(f"Tamaño total: {cache.total_bytes / 1024 / 1024:,.1f} MB de {CACHE_MAX_BYTES / 1024 / 1024:,.0f} MB")
+    col_purga1, col_purga2 = st.columns(2)
+    if col_purga1.button("Purgar caducadas"):
+        cache.purgar(solo_caducadas=True)
+        st.rerun()
+    if col_purga2.button("Vaciar caché"):
+        cache.purgar()
+        st.rerun()
+    resumen_sync = obtener_estado_sync().resumen()
+    if not resumen_sync.empty:
+        st.write("**Sincronizaciones incrementales:**")
+        st.dataframe(resumen_sync, hide_index=True)
+
+opciones_descarga = {
+    "max_workers": int(max_workers),
+    "subconsultas_paralelas": int(subconsultas_paralelas),
+    "peticiones_por_segundo": float(peticiones_por_segundo),
+    "usar_cache": usar_cache,
+    "sync_incremental": sync_incremental,
+}
+
+with bloqueo_trabajos():
+    activas = {consulta for consulta, trabajo in obtener_trabajos().items() if trabajo.activo()}
+interrumpidas = [
+    parametros for parametros in descargas_interrumpidas()
+    if (tuple(parametros["years"]), parametros["region"], parametros["tipo"]) not in activas
+]
+if interrumpidas:
+    with st.sidebar.expander(f"⏯️ Descargas interrumpidas ({len(interrumpidas)})"):
+        for idx, parametros in enumerate(interrumpidas):
+            st.write(f"{parametros['years'][0]}-{parametros['years'][-1]} | {parametros['region']} | {parametros['tipo']}")
+            if st.button("▶️ Reanudar", key=f"reanudar-{idx}"):
+                lanzar_trabajo(parametros["years"], parametros["region"], parametros["tipo"], parametros["opciones"])
+
+FACETAS_BUSQUEDA = {
+    "tipo_contratacion": "Tipo de contratación",
+    "provincia": "Provincia",
+    "anio": "Año",
+    "entidad_compradora": "Entidad compradora",
+    "proveedor": "Proveedor",
+}
+
+with st.sidebar.expander("🔎 Búsqueda local"):
+    busqueda_activa = st.toggle(
+        "Explorar los datos descargados", key="busqueda-activa",
+        help="Busca por texto y filtra por facetas, monto y fecha sobre todo lo guardado en el almacén local, sin consultar la API"
+    )
+    if busqueda_activa:
+        indice = obtener_indice()
+        with st.spinner("Actualizando el índice de búsqueda..."):
+            indice.sincronizar()
+        filtros_busqueda = {
+            "texto": st.text_input(
+                "Texto", key="busqueda-texto", placeholder="alcantarillado cuenca",
+                help="Entidad, proveedor, título, descripción o tipo; sin distinguir tildes ni mayúsculas"
+            ),
+            "monto_min": st.number_input("Monto mínimo (USD)", min_value=0.0, value=None, step=1000.0, placeholder="Sin límite"),
+            "monto_max": st.number_input("Monto máximo (USD)", min_value=0.0, value=None, step=1000.0, placeholder="Sin límite"),
+        }
+        rango_fechas = st.date_input("Rango de fechas", value=[], key="busqueda-fechas")
+        if len(rango_fechas) == 2:
+            filtros_busqueda["fecha_desde"] = rango_fechas[0].isoformat()
+            filtros_busqueda["fecha_hasta"] = rango_fechas[1].isoformat()
+        # Cada faceta se cuenta con el resto de selecciones aplicadas, así que se leen todas antes de dibujarlas
+        for columna in FACETAS_BUSQUEDA:
+            filtros_busqueda[columna] = st.session_state.get(f"busqueda-{columna}", [])
+        for columna, etiqueta in FACETAS_BUSQUEDA.items():
+            faceta = indice.facetas(columna, filtros_busqueda)
+            conteos = dict(zip(faceta[columna].tolist(), faceta["cantidad"].tolist()))
+            st.multiselect(
+                etiqueta, list(dict.fromkeys([*filtros_busqueda[columna], *conteos])), key=f"busqueda-{columna}",
+                format_func=lambda valor, conteos=conteos: f"{valor} ({conteos.get(valor, 0):,})"
+            )
+
 if st.sidebar.button("🔍 Cargar datos"):
-    if tipo_contratacion != "TODAS":
-        search_term = tipo_contratacion
+    if usar_almacen and almacen_completo(years, region, tipo_contratacion):
+        # La consulta cargada se conserva entre interacciones; los widgets ya no relanzan la descarga
+        st.session_state["consulta"] = (tuple(years), region, tipo_contratacion)
+        st.session_state["registro_descarga"] = [("success", "📦 Datos leídos del almacén local")]
+        st.session_state.pop("metricas_descarga", None)
     else:
-        search_term = "proceso"  
-    
+        lanzar_trabajo(years, region, tipo_contratacion, opciones_descarga)
+
+trabajo_actual = obtener_trabajos().get(st.session_state.get("trabajo"))
+if trabajo_actual is not None:
+    if trabajo_actual.activo():
+        progreso_descarga(trabajo_actual)
+    else:
+        st.session_state["registro_descarga"] = list(trabajo_actual.mensajes)
+        st.session_state["metricas_descarga"] = trabajo_actual.metricas
+        if trabajo_actual.estado == "completado":
+            st.session_state["consulta"] = trabajo_actual.consulta
+        del st.session_state["trabajo"]
+
+if st.session_state.get("registro_descarga"):
+    registro = st.session_state["registro_descarga"]
+    with st.expander("📋 Registro de la última descarga", expanded=any(nivel == "error" for nivel, _ in registro)):
+        for nivel, texto in registro:
+            getattr(st, nivel)(texto)
+
+if busqueda_activa:
+    st.subheader("🔎 Búsqueda en los datos descargados")
+    total_indexados = indice.total()
+    if total_indexados == 0:
+        st.info("El almacén local está vacío: carga alguna consulta para poder explorarla aquí.")
+    else:
+        inicio_busqueda = time.perf_counter()
+        encontrados, monto_encontrado = indice.resumen(filtros_busqueda)
+        resultados = indice.buscar(filtros_busqueda)
+        duracion_busqueda = time.perf_counter() - inicio_busqueda
+        col_b1, col_b2, col_b3 = st.columns(3)
+        col_b1.metric("Procesos encontrados", f"{encontrados:,}")
+        col_b2.metric("Monto total", f"${monto_encontrado:,.2f}")
+        col_b3.metric("Procesos indexados", f"{total_indexados:,}")
+        st.caption(
+            f"Resuelto en {duracion_busqueda * 1000:,.0f} ms sobre el índice local. "
+            f"Se muestran hasta {LIMITE_RESULTADOS} procesos, de mayor a menor monto."
+        )
+        st.dataframe(resultados, hide_index=True)
+        col_f1, col_f2 = st.columns(2)
+        with col_f1:
+            st.write("**Principales entidades compradoras**")
+            st.dataframe(indice.facetas("entidad_compradora", filtros_busqueda, limite=10), hide_index=True)
+        with col_f2:
+            st.write("**Principales proveedores**")
+            st.dataframe(indice.facetas("proveedor", filtros_busqueda, limite=10), hide_index=True)
+
+if "consulta" in st.session_state:
+    years, region, tipo_contratacion = st.session_state["consulta"]
+    analizar_todos_anos = len(years) > 1
+    version = version_almacen(years, region, tipo_contratacion)
+    metricas_vista = Metricas()
+
     # Construcción de filtros activos
     if analizar_todos_anos:
-        filtros_activos = f"**Filtros aplicados:** Años 2015-2025"
+        filtros_activos = f"**Filtros aplicados:** Años {years[0]}-{years[-1]}"
     else:
-        filtros_activos = f"**Filtros aplicados:** Año {year}"
+        filtros_activos = f"**Filtros aplicados:** Año {years[0]}"
     
     if region != "TODAS":
         filtros_activos += f" | Provincia: {region}"
@@ -73,187 +400,39 @@ if st.sidebar.button("🔍 Cargar datos"):
         filtros_activos += " | Tipo: TODAS"
     
     st.info(filtros_activos)
-    
-    if analizar_todos_anos:
-        st.warning(f"⚠️ Analizando {len(years)} años. Este proceso puede tardar bastante tiempo (varios minutos).")
-    else:
-        st.info("Cargando datos desde la API oficial... esto puede tardar varios minutos")
-
-    url = "https://datosabiertos.compraspublicas.gob.ec/PLATAFORMA/api/search_ocds"
-    
-    all_data = []
-    
-   
-    for year_idx, current_year in enumerate(years):
-        st.subheader(f"📥 Descargando datos del año {current_year}...")
-        
-        page = 1
-        max_consecutive_empty = 3  
-        empty_pages = 0
-        year_data = []
-        
-        progress_placeholder = st.empty()
-        status_text = st.empty()
-        
-        while True:
-            params = {
-                "year": current_year,
-                "search": search_term,
-                "page": page
-            }
-            
-            if region != "TODAS":
-                params["buyer"] = region
-            
-            try:
-                status_text.text(f"Año {current_year} - Página {page}... ({len(year_data)} registros)")
-                response = requests.get(url, params=params, timeout=30)
-                response.raise_for_status()
-                data = response.json()
-                
-                if "data" in data and len(data["data"]) > 0:
-                    year_data.extend(data["data"])
-                    empty_pages = 0  
-                    
-                    total_pages = data.get("pages", "?")
-                    progress_placeholder.info(f"📊 Año {current_year} - Página {page} de {total_pages} | Registros: {len(year_data)}")
-                    
-                    if page >= data.get("pages", page):
-                        status_text.success(f"✅ Año {current_year} completado ({len(year_data)} registros)")
-                        break
-                        
-                    page += 1
-                    time.sleep(0.3)  
-                else:
-                    empty_pages += 1
-                    if empty_pages >= max_consecutive_empty:
-                        status_text.warning(f"⚠️ No hay más datos para el año {current_year}")
-                        break
-                    page += 1
-                    
-            except requests.exceptions.RequestException as e:
-                st.error(f"❌ Error de conexión en año {current_year}, página {page}: {e}")
-                break
-            except Exception as e:
-                st.error(f"❌ Error al procesar datos del año {current_year}, página {page}: {e}")
-                break
-        
-        all_data.extend(year_data)
-        progress_placeholder.empty()
-        status_text.empty()
-        
-        st.success(f"✅ Año {current_year}: {len(year_data)} registros obtenidos")
-    
-    if not all_data:
-        st.error("❌ No se encontraron datos con los filtros aplicados")
-        st.stop()
-    
-    df = pd.DataFrame(all_data)
-    
-    if analizar_todos_anos:
-        st.success(f"✅ Datos cargados correctamente - {len(df)} registros obtenidos de {len(years)} años")
-    else:
-        st.success(f"✅ Datos cargados correctamente - {len(df)} registros obtenidos")
-    
-    
-    st.info("🔍 Obteniendo montos de contratos... esto puede tardar unos minutos")
-    
-    montos_data = []
-    progress_bar = st.progress(0)
-    status_monto = st.empty()
-    
-    max_ocids = min(len(df), 500)
-    
-    for idx, ocid in enumerate(df['ocid'].head(max_ocids)):
-        try:
-            status_monto.text(f"Consultando monto {idx + 1} de {max_ocids}...")
-            record_url = "https://datosabiertos.compraspublicas.gob.ec/PLATAFORMA/api/record"
-            response = requests.get(record_url, params={"ocid": ocid}, timeout=15)
-            
-            if response.status_code == 200:
-                record_data = response.json()
-                
-                if "records" in record_data and len(record_data["records"]) > 0:
-                    releases = record_data["records"][0].get("releases", [])
-                    if releases:
-                        release = releases[0]
-                        
-                        contracts = release.get("contracts", [])
-                        monto = 0
-                        num_contracts = 0
-                        
-                        for contract in contracts:
-                            if "value" in contract and "amount" in contract["value"]:
-                                monto += float(contract["value"]["amount"])
-                                num_contracts += 1
-                        
-                        if monto == 0:
-                            awards = release.get("awards", [])
-                            for award in awards:
-                                if "value" in award and "amount" in award["value"]:
-                                    monto += float(award["value"]["amount"])
-                        
-                        montos_data.append({
-                            "ocid": ocid,
-                            "monto_total": monto,
-                            "num_contratos": num_contracts if num_contracts > 0 else 1
-                        })
-            
-            progress_bar.progress((idx + 1) / max_ocids)
-            time.sleep(0.2) 
-            
-        except Exception as e:
-            continue
-    
-    progress_bar.empty()
-    status_monto.empty()
-    
-    if montos_data:
-        df_montos = pd.DataFrame(montos_data)
-        df = df.merge(df_montos, on="ocid", how="left")
-        df["monto_total"] = df["monto_total"].fillna(0)
-        df["num_contratos"] = df["num_contratos"].fillna(0)
-        st.success(f"✅ Montos obtenidos para {len(montos_data)} registros")
-    else:
-        df["monto_total"] = 0
-        df["num_contratos"] = 0
-        st.warning("⚠️ No se pudieron obtener montos para estos registros")
 
     st.subheader("🧹 Limpieza de datos")
 
-    rename_map = {
-        "buyerName": "entidad_compradora",
-        "internal_type": "tipo_contratacion",
-        "single_provider": "proveedor"
-    }
-    df = df.rename(columns=rename_map)
-
-    if "date" in df.columns:
-        df["date"] = pd.to_datetime(df["date"], errors="coerce")
-        df["year"] = df["date"].dt.year
-        df["month"] = df["date"].dt.month
-        df["month_name"] = df["date"].dt.strftime('%B')
-
-    df = df.drop_duplicates(subset=["ocid"], keep="first")
+    with metricas_vista.etapa("carga_dataset") as etapa:
+        dataset = resumir_dataset(years, region, tipo_contratacion, version)
+        etapa["filas"] = dataset["filas"]
 
     st.write("**Vista previa de datos limpios:**")
-    st.dataframe(df.head(10))
+    st.dataframe(dataset["vista"])
 
     col_info1, col_info2 = st.columns(2)
     with col_info1:
-        st.write(f"**Dimensiones:** {df.shape[0]} filas × {df.shape[1]} columnas")
+        st.write(f"**Dimensiones:** {dataset['filas']} filas × {len(dataset['columnas'])} columnas")
     with col_info2:
-        st.write(f"**Columnas disponibles:** {', '.join(df.columns[:5])}...")
+        st.write(f"**Columnas disponibles:** {', '.join(dataset['columnas'][:5])}...")
+    st.caption(
+        f"🧮 Memoria del dataset: {dataset['memoria_antes']:,.1f} MB → {dataset['memoria_despues']:,.1f} MB "
+        f"con tipos compactos (categorías y enteros reducidos)"
+    )
 
     st.subheader("📈 Análisis Descriptivo")
 
-    total_registros = len(df)
-    monto_total = df["monto_total"].sum()
-    promedio = df["monto_total"].mean()
-    total_contratos = df["num_contratos"].sum()
-    tipos_unicos = df["tipo_contratacion"].nunique() if "tipo_contratacion" in df.columns else 0
-    entidades_unicas = df["entidad_compradora"].nunique() if "entidad_compradora" in df.columns else 0
-    proveedores_unicos = df["proveedor"].nunique() if "proveedor" in df.columns else 0
+    with metricas_vista.etapa("rollups"):
+        rollups = calcular_rollups(years, region, tipo_contratacion, version)
+    cubo = rollups["cubo"]
+
+    total_registros = int(cubo["cantidad"].sum())
+    monto_total = cubo["monto_total"].sum()
+    promedio = monto_total / total_registros if total_registros else 0
+    total_contratos = cubo["num_contratos"].sum()
+    tipos_unicos = cubo["tipo_contratacion"].nunique()
+    entidades_unicas = rollups["entidades_unicas"]
+    proveedores_unicos = rollups["proveedores_unicos"]
 
     col1, col2, col3, col4 = st.columns(4)
     col1.metric("Total de registros", f"{total_registros:,}")
@@ -269,18 +448,14 @@ if st.sidebar.button("🔍 Cargar datos"):
     st.subheader("📊 Visualizaciones")
 
     
-    if analizar_todos_anos and "year" in df.columns:
-        year_stats = df.groupby("year").agg({
-            "ocid": "count",
-            "monto_total": "sum"
-        }).reset_index()
-        year_stats.columns = ["year", "cantidad", "monto_total"]
+    if analizar_todos_anos:
+        year_stats = cubo.groupby("year")[["cantidad", "monto_total"]].sum().reset_index()
         
         fig_year = px.bar(year_stats, x="year", y="cantidad",
                           title="📅 Evolución Anual de Procesos de Contratación (2015-2025)",
                           text_auto=True,
                           labels={"cantidad": "Cantidad de Procesos", "year": "Año"})
-        st.plotly_chart(fig_year, use_container_width=True)
+        mostrar_grafico(fig_year, "anual_cantidad", metricas_vista)
         st.caption("👉 Evolución histórica de la cantidad de procesos por año.")
         
         if year_stats["monto_total"].sum() > 0:
@@ -288,132 +463,142 @@ if st.sidebar.button("🔍 Cargar datos"):
                                       title="💰 Evolución Anual de Montos Totales (2015-2025)",
                                       markers=True,
                                       labels={"monto_total": "Monto Total ($)", "year": "Año"})
-            st.plotly_chart(fig_year_monto, use_container_width=True)
+            mostrar_grafico(fig_year_monto, "anual_monto", metricas_vista)
             st.caption("👉 Evolución histórica de los montos contratados por año.")
 
-    if "tipo_contratacion" in df.columns and df["monto_total"].sum() > 0:
-        tipo_monto = df.groupby("tipo_contratacion")["monto_total"].sum().reset_index()
-        tipo_monto = tipo_monto[tipo_monto["monto_total"] > 0]
+    tipo_stats = cubo.groupby("tipo_contratacion", observed=True)[["cantidad", "monto_total"]].sum().reset_index()
+
+    if monto_total > 0:
+        tipo_monto = limitar_categorias(tipo_stats[tipo_stats["monto_total"] > 0], "tipo_contratacion", "monto_total")
         if not tipo_monto.empty:
             fig1 = px.bar(tipo_monto, x="tipo_contratacion", y="monto_total",
                           title="a) Monto Total por Tipo de Contratación",
                           color="tipo_contratacion", text_auto=".2s",
                           labels={"monto_total": "Monto Total ($)", "tipo_contratacion": "Tipo de Contratación"})
-            st.plotly_chart(fig1, use_container_width=True)
+            mostrar_grafico(fig1, "monto_por_tipo", metricas_vista)
             st.caption("👉 Se observa el monto total por tipo de contratación en el período analizado.")
 
-    if "tipo_contratacion" in df.columns:
-        tipo_count = df["tipo_contratacion"].value_counts().reset_index()
-        tipo_count.columns = ["tipo_contratacion", "cantidad"]
+    if not tipo_stats.empty:
+        tipo_count = limitar_categorias(tipo_stats[["tipo_contratacion", "cantidad"]], "tipo_contratacion")
+        tipo_count = tipo_count.sort_values("cantidad", ascending=False)
         fig2 = px.bar(tipo_count, x="tipo_contratacion", y="cantidad",
                       title="b) Cantidad de Procesos por Tipo de Contratación",
                       color="tipo_contratacion", text_auto=True,
                       labels={"cantidad": "Cantidad de Procesos", "tipo_contratacion": "Tipo de Contratación"})
-        st.plotly_chart(fig2, use_container_width=True)
+        mostrar_grafico(fig2, "cantidad_por_tipo", metricas_vista)
         st.caption("👉 Se observa la frecuencia de cada tipo de contratación.")
 
-    if "month" in df.columns and not analizar_todos_anos:
-        mes_count = df.groupby("month").size().reset_index(name="cantidad")
-        fig2 = px.line(mes_count, x="month", y="cantidad",
+    mes_stats = cubo.groupby("month")[["cantidad", "monto_total"]].sum().reset_index()
+
+    if not mes_stats.empty and not analizar_todos_anos:
+        fig2 = px.line(mes_stats, x="month", y="cantidad",
                        title="b) Evolución Mensual de Procesos de Contratación",
                        markers=True,
                        labels={"cantidad": "Cantidad de Procesos", "month": "Mes"})
-        st.plotly_chart(fig2, use_container_width=True)
+        mostrar_grafico(fig2, "cantidad_mensual", metricas_vista)
         st.caption("👉 Se aprecian los meses con mayor actividad en contratación pública.")
 
-    if "month" in df.columns and df["monto_total"].sum() > 0 and not analizar_todos_anos:
-        mes_monto = df.groupby("month")["monto_total"].sum().reset_index()
-        fig3 = px.line(mes_monto, x="month", y="monto_total",
+    if not mes_stats.empty and monto_total > 0 and not analizar_todos_anos:
+        fig3 = px.line(mes_stats, x="month", y="monto_total",
                        title="c) Evolución Mensual de Montos Totales",
                        markers=True,
                        labels={"monto_total": "Monto Total ($)", "month": "Mes"})
-        st.plotly_chart(fig3, use_container_width=True)
+        mostrar_grafico(fig3, "monto_mensual", metricas_vista)
         st.caption("👉 Se aprecian los meses con mayores montos contratados.")
 
-    if "entidad_compradora" in df.columns:
-        top_buyers = df["entidad_compradora"].value_counts().head(10).reset_index()
-        top_buyers.columns = ["entidad_compradora", "cantidad"]
+    top_buyers = rollups["top_entidades"].top(10, "entidad_compradora")
+    if not top_buyers.empty:
         fig4 = px.bar(top_buyers, x="cantidad", y="entidad_compradora",
                       title="d) Top 10 Entidades Compradoras",
                       orientation="h",
                       labels={"cantidad": "Cantidad de Procesos", "entidad_compradora": "Entidad"})
-        st.plotly_chart(fig4, use_container_width=True)
+        mostrar_grafico(fig4, "top_entidades", metricas_vista)
         st.caption("👉 Entidades con mayor cantidad de procesos de contratación.")
 
-    if "tipo_contratacion" in df.columns:
-        fig4 = px.pie(df, names="tipo_contratacion",
+    if not tipo_stats.empty:
+        fig4 = px.pie(tipo_count, names="tipo_contratacion", values="cantidad",
                       title="d) Proporción de Contratos por Tipo")
-        st.plotly_chart(fig4, use_container_width=True)
+        mostrar_grafico(fig4, "proporcion_tipos", metricas_vista)
         st.caption("👉 Representación porcentual de la distribución de procesos por tipo.")
 
-    if "month" in df.columns and "tipo_contratacion" in df.columns and not analizar_todos_anos:
-        tipo_mes = df.groupby(["month", "tipo_contratacion"]).size().reset_index(name="cantidad")
-        fig5 = px.bar(tipo_mes, x="month", y="cantidad", 
-                      color="tipo_contratacion",
-                      title="e) Procesos por Mes y Tipo de Contratación",
-                      barmode="stack",
-                      labels={"cantidad": "Cantidad de Procesos", "month": "Mes", "tipo_contratacion": "Tipo"})
-        st.plotly_chart(fig5, use_container_width=True)
-        st.caption("👉 Distribución mensual detallada por tipo de contratación.")
-
-    if "proveedor" in df.columns:
-        top_suppliers = df["proveedor"].value_counts().head(10).reset_index()
-        top_suppliers.columns = ["proveedor", "cantidad"]
+    if not mes_stats.empty and not analizar_todos_anos:
+        grafico_mes_tipo(cubo)
+
+    top_suppliers = rollups["top_proveedores"].top(10, "proveedor")
+    if not top_suppliers.empty:
         fig6 = px.bar(top_suppliers, x="cantidad", y="proveedor",
                       title="f) Top 10 Proveedores",
                       orientation="h",
                       labels={"cantidad": "Contratos Ganados", "proveedor": "Proveedor"})
-        st.plotly_chart(fig6, use_container_width=True)
+        mostrar_grafico(fig6, "top_proveedores", metricas_vista)
         st.caption("👉 Proveedores con mayor cantidad de contratos adjudicados.")
 
     
-    if "year" in df.columns and "tipo_contratacion" in df.columns:
-        tipo_year = df.groupby(["year", "tipo_contratacion"]).size().reset_index(name="cantidad")
-        
-        fig_comp = px.line(tipo_year, x="year", y="cantidad", 
-                          color="tipo_contratacion",
-                          title="g) Comparativa de Tipos de Contratación por Año",
-                          markers=True,
-                          labels={"cantidad": "Cantidad de Procesos", "year": "Año", "tipo_contratacion": "Tipo"})
-        st.plotly_chart(fig_comp, use_container_width=True)
-        st.caption("👉 Evolución temporal de cada tipo de contratación a lo largo de los años analizados.")
-        
-       
-        if df["monto_total"].sum() > 0:
-            tipo_year_monto = df.groupby(["year", "tipo_contratacion"])["monto_total"].sum().reset_index()
-            tipo_year_monto = tipo_year_monto[tipo_year_monto["monto_total"] > 0]
-            
-            if not tipo_year_monto.empty:
-                fig_comp_monto = px.line(tipo_year_monto, x="year", y="monto_total", 
-                                        color="tipo_contratacion",
-                                        title="h) Comparativa de Montos por Tipo de Contratación y Año",
-                                        markers=True,
-                                        labels={"monto_total": "Monto Total ($)", "year": "Año", "tipo_contratacion": "Tipo"})
-                st.plotly_chart(fig_comp_monto, use_container_width=True)
-                st.caption("👉 Evolución de los montos contratados por tipo a lo largo de los años.")
+    if not tipo_stats.empty:
+        comparativas_anuales(cubo, monto_total)
 
     st.subheader("💾 Exportar resultados")
 
-    csv = df.to_csv(index=False).encode("utf-8")
-    
-    if analizar_todos_anos:
-        filename = f"compras_publicas_2015-2025"
-    else:
-        filename = f"compras_publicas_{years[0]}"
-    
-    if tipo_contratacion != "TODAS":
-        filename += f"_{tipo_contratacion.replace(' ', '_')}"
-    if region != "TODAS":
-        filename += f"_{region.replace(' ', '_')}"
-    filename += ".csv"
-    
+    col_exp1, col_exp2 = st.columns(2)
+    formato_exportacion = col_exp1.selectbox(
+        "Formato", list(FORMATOS_EXPORTACION),
+        format_func={"csv": "CSV", "csv.gz": "CSV comprimido (gzip)", "parquet": "Parquet"}.get
+    )
+    exportar_resumen = col_exp2.toggle(
+        "Solo resumen agregado", value=False,
+        help="Exporta el cubo año × mes × tipo × provincia (cantidad, monto y contratos) en lugar de cada registro"
+    )
+
+    filename = nombre_archivo(years, region, tipo_contratacion) + ("_resumen" if exportar_resumen else "")
+    filename += f".{formato_exportacion}"
+
+    # El archivo se escribe por lotes desde el almacén solo al pulsar el botón
     st.download_button(
-        "📥 Descargar datos limpios (CSV)",
-        csv,
+        "📥 Descargar " + ("resumen agregado" if exportar_resumen else "datos limpios"),
+        lambda: preparar_exportacion(
+            years, region, tipo_contratacion, formato_exportacion, exportar_resumen
+        ).read_bytes(),
         filename,
-        "text/csv",
+        FORMATOS_EXPORTACION[formato_exportacion],
         key="download-csv"
     )
+
+    with st.expander("⏱️ Rendimiento"):
+        metricas = Metricas()
+        if "metricas_descarga" in st.session_state:
+            metricas.agregar(st.session_state["metricas_descarga"])
+            peticiones = metricas.total("http_peticiones_total")
+            aciertos_cache = metricas.total("cache_aciertos_total")
+            consultas_cache = aciertos_cache + metricas.total("cache_fallos_total")
+            col_r1, col_r2, col_r3, col_r4 = st.columns(4)
+            col_r1.metric("Peticiones HTTP", f"{peticiones:,}")
+            col_r2.metric("Descargado", f"{metricas.total('http_bytes_total') / 1024 / 1024:,.1f} MB")
+            col_r3.metric("Reintentos", f"{metricas.total('http_reintentos_total'):,}")
+            col_r4.metric("Aciertos de caché", f"{aciertos_cache / consultas_cache:.0%}" if consultas_cache else "—")
+            histograma = metricas.histograma("http_latencia_segundos")
+            if not histograma.empty:
+                fig_latencia = px.bar(histograma, x="hasta", y="cantidad",
+                                      title="Latencia de las peticiones HTTP",
+                                      labels={"hasta": "Latencia", "cantidad": "Peticiones"})
+                st.plotly_chart(fig_latencia, width="stretch")
+        else:
+            st.caption("Los datos se leyeron del almacén local; no hubo descarga en esta sesión.")
+        metricas.agregar(metricas_vista)
+        for metricas_grafico in st.session_state.get("metricas_fragmentos", {}).values():
+            metricas.agregar(metricas_grafico)
+        st.write("**Tiempo por etapa:**")
+        st.dataframe(metricas.tabla_etapas(), hide_index=True)
+        st.caption(
+            "👉 Las etapas de carga, agregados y gráficos son las de esta ejecución; si vienen del caché de Streamlit "
+            "tardan casi cero. Los gráficos opcionales (e, g y h) cuentan con su última ejecución, y un cambio en su "
+            "interruptor se refleja aquí en la siguiente recarga de la página."
+        )
+        base_metricas = nombre_archivo(years, region, tipo_contratacion) + "_metricas"
+        col_m1, col_m2 = st.columns(2)
+        col_m1.download_button("📥 Métricas (JSON)", metricas.exportar_json(), base_metricas + ".json",
+                               "application/json", key="download-metricas-json")
+        col_m2.download_button("📥 Métricas (Prometheus)", metricas.exportar_prometheus(), base_metricas + ".prom",
+                               "text/plain", key="download-metricas-prom")
    
     st.subheader("🧠 Conclusiones del análisis")
     
@@ -478,4 +663,4 @@ else:
     - Datos exportables en CSV
     
     **Nota:** Este análisis usa el endpoint oficial `/search_ocds` de la API de Compras Públicas de Ecuador.
-    """)
\ No newline at end of file
+    """)
@@ -0,0 +1,171 @@
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import compras_publicas as cp
+
+
+def lote_vacio():
+    return cp.normalizar_lote([], 2024, "Azuay", "Obras")
+
+
+def test_descartar_vistos_lote_vacio():
+    vistos = {"a"}
+    df = cp.descartar_vistos(lote_vacio(), vistos)
+    assert df.empty
+    assert "ocid" in df.columns
+    assert vistos == {"a"}
+
+
+def test_descartar_vistos_quita_vistos_y_repetidos():
+    vistos = {"a"}
+    df = pd.DataFrame({"ocid": pd.array(["a", "b", "b", "c"], dtype="string"), "valor": [1, 2, 3, 4]})
+    df = cp.descartar_vistos(df, vistos)
+    assert df["ocid"].tolist() == ["b", "c"]
+    assert df["valor"].tolist() == [2, 4]
+    assert vistos == {"a", "b", "c"}
+
+
+def test_agregar_lote_vacio(tmp_path):
+    lotes = cp.DirectorioLotes(tmp_path / "lotes")
+    assert lotes.agregar(lote_vacio(), cp.clave_subconsulta(2024, "Azuay", "Obras")) == 0
+    lotes.eliminar()
+
+
+def test_particion_vacia_en_rollups_y_exportacion(tmp_path, monkeypatch):
+    monkeypatch.setattr(cp, "ALMACEN_DIR", tmp_path / "almacen")
+    ruta = cp.ruta_particion(2024, "Azuay", "Obras")
+    ruta.parent.mkdir(parents=True)
+    vacio = lote_vacio().drop(columns=["anio_consulta", "provincia", "consulta"])
+    vacio["monto_total"] = pd.Series(dtype="float64")
+    vacio["num_contratos"] = pd.Series(dtype=cp.ESQUEMA["num_contratos"])
+    pq.write_table(pa.Table.from_pandas(vacio[cp.COLUMNAS_ALMACEN], preserve_index=False), ruta)
+
+    rollups = cp.construir_rollups([2024], "Azuay", "Obras")
+    assert rollups["cubo"].empty
+    assert list(cp.iterar_exportacion([2024], "Azuay", "Obras")) == []
+
+
+def test_escrituras_concurrentes_de_una_particion(tmp_path, monkeypatch):
+    monkeypatch.setattr(cp, "ALMACEN_DIR", tmp_path / "almacen")
+    clave = cp.clave_subconsulta(2024, "Azuay", "Obras")
+    directorios = []
+    for indice in range(4):
+        lotes = cp.DirectorioLotes(tmp_path / f"lotes-{indice}")
+        registros = [{"ocid": f"o-{indice}-{i}", "date": "2024-05-01T10:00:00-05:00"} for i in range(2000)]
+        lotes.agregar(cp.normalizar_lote(registros, 2024, "Azuay", "Obras"), clave)
+        lotes.checkpoint["completas"] = [clave]
+        directorios.append(lotes)
+
+    montos = cp.extraer_montos({})
+    with cp.ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(lambda lotes: cp.escribir_almacen(lotes, montos), directorios))
+
+    ruta = cp.ruta_particion(2024, "Azuay", "Obras")
+    assert pq.read_table(ruta).num_rows == 2000
+    assert list(ruta.parent.iterdir()) == [ruta]
+
+
+def test_topk_acota_las_frecuencias():
+    rng = np.random.default_rng(0)
+    valores = pd.Series(rng.zipf(1.5, 20000) % 300)
+    topk = cp.TopK(capacidad=20)
+    for inicio in range(0, len(valores), 1000):
+        topk.agregar(valores.iloc[inicio:inicio + 1000].value_counts())
+
+    reales = valores.value_counts()
+    top = topk.top(10, "valor")
+    assert (top["cantidad"] >= reales[top["valor"]].to_numpy()).all()
+    assert (top["cantidad"] - top["error"] <= reales[top["valor"]].to_numpy()).all()
+    assert set(top["valor"][:5]) == set(reales.index[:5])
+
+
+def test_topk_valor_desalojado_hereda_el_minimo():
+    topk = cp.TopK(capacidad=2)
+    topk.agregar(pd.Series({"a": 5, "b": 3}))
+    topk.agregar(pd.Series({"c": 1}))
+    assert topk.contadores == {"a": 5, "c": 4}
+    topk.agregar(pd.Series({"b": 2}))
+    assert topk.contadores == {"a": 5, "b": 6}
+    assert topk.errores == {"a": 0, "b": 4}
+
+
+def record(*releases):
+    return {"records": [{"ocid": "x", "releases": list(releases)}]}
+
+
+def montos_por_ocid(respuestas):
+    df = cp.extraer_montos(respuestas)
+    return {fila.ocid: (fila.monto_total, fila.num_contratos) for fila in df.itertuples()}
+
+
+def test_extraer_montos_contrato_repetido_entre_releases():
+    respuestas = {"o1": record(
+        {"contracts": [{"id": "c1", "value": {"amount": 100}}, {"id": "c2", "value": {"amount": 50}}]},
+        {"contracts": [{"id": "c1", "value": {"amount": 120}}]},
+    )}
+    assert montos_por_ocid(respuestas) == {"o1": (170.0, 2)}
+
+
+def test_extraer_montos_usa_adjudicaciones_sin_contratos():
+    respuestas = {
+        "o1": record({"contracts": [], "awards": [{"id": "a1", "value": {"amount": 80}}]}),
+        "o2": record({"contracts": [{"id": "c1", "value": {}}], "awards": [{"value": {"amount": "30.5"}}]}),
+    }
+    assert montos_por_ocid(respuestas) == {"o1": (80.0, 1), "o2": (30.5, 1)}
+
+
+def test_extraer_montos_ignora_respuestas_malformadas():
+    respuestas = {
+        "sin_release": {"records": [{"releases": [None]}]},
+        "lista": [],
+        "nulo": None,
+        "sin_records": {"records": None},
+        "partes_malas": record(
+            {"contracts": [None, {"id": "c1", "value": 5}, {"id": {"x": 1}, "value": {"amount": 40}}]},
+            {"contracts": {"id": "c2"}, "awards": "nada"},
+            "release",
+        ),
+        "bueno": record({"contracts": [{"id": "c1", "value": {"amount": [1]}}, {"id": "c2", "value": {"amount": 7}}]}),
+    }
+    assert montos_por_ocid(respuestas) == {"partes_malas": (40.0, 1), "bueno": (7.0, 1)}
+
+
+def test_indice_provincia_de_ocid_compartido_con_consulta_nacional(tmp_path, monkeypatch):
+    monkeypatch.setattr(cp, "ALMACEN_DIR", tmp_path / "almacen")
+    for region, ocids in (("TODAS", ["o1", "o2"]), ("Azuay", ["o1"])):
+        lotes = cp.DirectorioLotes(tmp_path / f"lotes-{region}")
+        clave = cp.clave_subconsulta(2024, region, "Obras")
+        registros = [{"ocid": ocid, "date": "2024-05-01T10:00:00-05:00"} for ocid in ocids]
+        lotes.agregar(cp.normalizar_lote(registros, 2024, region, "Obras"), clave)
+        lotes.checkpoint["completas"] = [clave]
+        cp.escribir_almacen(lotes, cp.extraer_montos({}))
+
+    indice = cp.IndiceBusqueda(tmp_path / "indice.sqlite")
+    assert indice.sincronizar() == 2
+    assert indice.total() == 2
+    faceta = indice.facetas("provincia", {})
+    assert dict(zip(faceta["provincia"], faceta["cantidad"])) == {"Azuay": 1}
+    assert indice.buscar({"provincia": ["Azuay"]})["ocid"].tolist() == ["o1"]
+    assert indice.resumen({"provincia": ["Azuay"]})[0] == 1
+
+
+def test_almacen_completo_refresca_el_anio_en_curso(tmp_path, monkeypatch):
+    monkeypatch.setattr(cp, "ALMACEN_DIR", tmp_path / "almacen")
+    actual = datetime.now().year
+    for anio in (actual - 1, actual):
+        ruta = cp.ruta_particion(anio, "Azuay", "Obras")
+        ruta.parent.mkdir(parents=True)
+        ruta.touch()
+    assert cp.almacen_completo([actual - 1, actual], "Azuay", "Obras")
+
+    antiguo = time.time() - cp.TTL_ANIO_ACTUAL - 60
+    for anio in (actual - 1, actual):
+        os.utime(cp.ruta_particion(anio, "Azuay", "Obras"), (antiguo, antiguo))
+    assert cp.almacen_completo([actual - 1], "Azuay", "Obras")
+    assert not cp.almacen_completo([actual - 1, actual], "Azuay", "Obras")